@@ -0,0 +1 @@
+"""Benchmarks for playlist operations. Each module may be run with python -m awp.benchmark.NAME"""
@@ -0,0 +1,70 @@
+
+"""Stress test for concurrent access to a shared playlist file.
+Usage:
+	python -m awp.benchmark.concurrency
+Also takes optional --options as follows:
+	--processes N: Number of processes to run at once. Default 16.
+	--updates N: Number of promotions each process makes. Default 100.
+	--entries N: Number of entries in the playlist. Default 100.
+	--journal: Save changes via the journal instead of rewriting the file.
+Each process repeatedly promotes a random entry (by adding 1 to its weight) and saves,
+as play does. Since each promotion is relative to the current weight, the final total weight
+shows whether any were lost. Exits with status 1 if they were.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+
+from scriptlib import with_argv
+
+from awp.playlist import Playlist
+from awp.benchmark.synthetic import synthetic_paths
+
+
+def promote(filepath, updates, journal, seed):
+	rng = random.Random(seed)
+	playlist = Playlist(filepath, journal=journal)
+	paths = playlist.entries.keys()
+	for _ in xrange(updates):
+		if playlist.changed_on_disk():
+			playlist.reload()
+		playlist.update(rng.choice(paths), weight=lambda x: x + 1)
+		playlist.save()
+
+
+@with_argv
+def main(processes=16, updates=100, entries=100, journal=False):
+	processes, updates, entries = int(processes), int(updates), int(entries)
+	tempdir = tempfile.mkdtemp(prefix='awp-concurrency-')
+	try:
+		filepath = os.path.join(tempdir, 'playlist')
+		playlist = Playlist()
+		for path in synthetic_paths(entries):
+			playlist.add_item(path, 1, 0.5)
+		playlist.writefile(filepath)
+
+		start = time.time()
+		procs = [Process(target=promote, args=(filepath, updates, journal, seed)) for seed in range(processes)]
+		for proc in procs:
+			proc.start()
+		for proc in procs:
+			proc.join()
+		elapsed = time.time() - start
+
+		expected = entries + processes * updates
+		total = sum(weight for weight, volume in Playlist(filepath).entries.itervalues())
+		print "{} promotions in {:.2f}s ({:.1f}/s), {} lost".format(
+			processes * updates, elapsed, processes * updates / elapsed, expected - total)
+		if total != expected or any(proc.exitcode for proc in procs):
+			sys.exit(1)
+	finally:
+		shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,86 @@
+"""Check that Playlist.next() still chooses with the right distribution after many updates
+to a playlist, ie. that the incrementally maintained sampling index hasn't drifted.
+Usage:
+	python -m awp.benchmark.distribution
+Also takes optional --options as follows:
+	--entries N: Number of entries to start with. Default 200.
+	--updates N: Number of random changes (weight changes, removals, additions) to make. Default 5000.
+	--draws N: Number of choices to make once updated. Default 200000.
+	--seed N: Random seed. Default 0.
+The counts of each entry chosen are compared to its share of the total weight with a chi-squared test.
+Exits with status 1 if the distribution is wrong at the 0.1% significance level,
+or if an entry with zero weight was ever chosen.
+"""
+
+import math
+import random
+import sys
+import time
+from collections import Counter
+
+from scriptlib import with_argv
+
+from awp.playlist import Playlist
+from awp.benchmark.synthetic import synthetic_paths
+
+
+Z_CRITICAL = 3.09 # standard normal quantile for 0.1% significance
+
+
+def chi_squared_critical(dof, z=Z_CRITICAL):
+	"""Approximate critical value of the chi-squared distribution (Wilson-Hilferty)"""
+	return dof * (1 - 2. / (9 * dof) + z * math.sqrt(2. / (9 * dof))) ** 3
+
+
+def random_updates(playlist, paths, updates, rng):
+	"""Make random changes to playlist, drawing new paths from the paths iterator"""
+	for _ in xrange(updates):
+		existing = playlist.entries.keys()
+		action = rng.random()
+		if action < 0.6 and existing:
+			playlist.update(rng.choice(existing), weight=rng.choice([0, 0.1, 1, 3.7, 16, 1000]))
+		elif action < 0.8 and existing:
+			playlist.remove_item(rng.choice(existing))
+		else:
+			playlist.add_item(next(paths), rng.uniform(0, 100), 0.5)
+		# interleave choices with the updates, so the index is kept up to date rather than rebuilt
+		if playlist.entries.total() > 0:
+			playlist.next()
+
+
+@with_argv
+def main(entries=200, updates=5000, draws=200000, seed=0):
+	entries, updates, draws = int(entries), int(updates), int(draws)
+	rng = random.Random(int(seed))
+	random.seed(int(seed))
+	paths = iter(synthetic_paths(entries + updates, seed=int(seed)))
+	playlist = Playlist()
+	for _ in xrange(entries):
+		playlist.add_item(next(paths), rng.uniform(0, 100), 0.5)
+
+	start = time.time()
+	random_updates(playlist, paths, updates, rng)
+	elapsed = time.time() - start
+
+	weights = {path: weight for path, (weight, volume) in playlist.entries.iteritems()}
+	total = sum(weights.values())
+	drift = abs(playlist.entries.total() - total)
+	counts = Counter(playlist.next()[0] for _ in xrange(draws))
+
+	zero_chosen = sum(counts[path] for path, weight in weights.items() if weight <= 0)
+	chosen = [path for path, weight in weights.items() if weight > 0]
+	statistic = sum(
+		(counts[path] - draws * weights[path] / total) ** 2 / (draws * weights[path] / total)
+		for path in chosen
+	)
+	critical = chi_squared_critical(len(chosen) - 1)
+	print "{} updates in {:.2f}s, {} entries ({} with weight), total drift {:.3g}".format(
+		updates, elapsed, len(weights), len(chosen), drift)
+	print "chi-squared {:.1f} (critical {:.1f}), {} choices of zero-weight entries".format(
+		statistic, critical, zero_chosen)
+	if statistic > critical or zero_chosen:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,163 @@
+"""Measure the gap between one track ending and the next starting, for each player backend.
+Usage:
+	python -m awp.benchmark.gap
+Also takes optional --options as follows:
+	--tracks N: Number of tracks to play with each backend. Default 50.
+	--length SECONDS: Length of each track. Default 0.1.
+	--missing N: Make every Nth track a file that doesn't exist, to check that the players move on
+	             past files mplayer can't open. 0 to disable. Default 10.
+Instead of mplayer, the players run a fake which plays each track by sleeping for its length,
+understands the slave mode commands we use (printing "EOF code:" when a track ends, as mplayer does),
+and logs when each track starts and ends. The gap is measured from those logs, so it includes
+everything between the fake finishing a track and starting the next: noticing the track finished,
+starting a new process if needed, and loading the next track.
+Gaps either side of a missing file aren't counted. If a backend is still waiting for a track
+well after it should have ended, it is reported as stalled and we exit with status 1.
+Note that starting the fake (a python interpreter) may be faster or slower than starting a real mplayer.
+"""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+import gevent
+from scriptlib import with_argv
+
+from awp.players import BACKENDS
+
+
+FAKE_MPLAYER = r'''#!{python}
+import os, select, shlex, sys, time
+
+length = float(os.environ['FAKE_MPLAYER_LENGTH'])
+log = open(os.environ['FAKE_MPLAYER_LOG'], 'a')
+
+def record(event):
+	log.write('{{}} {{!r}}\n'.format(event, time.time()))
+	log.flush()
+
+def failed(filename):
+	# as mplayer does, on stderr, and without an "EOF code:" line
+	record('failed')
+	sys.stderr.write("File not found: '{{}}'\nFailed to open {{}}.\n".format(filename, filename))
+	sys.stderr.flush()
+
+if '-slave' not in sys.argv:
+	if not os.path.exists(sys.argv[-1]):
+		failed(sys.argv[-1])
+		sys.exit(1)
+	record('start')
+	time.sleep(length)
+	record('end')
+	sys.exit(0)
+
+buf = ''
+end = None
+while True:
+	if '\n' not in buf:
+		timeout = None if end is None else max(0, end - time.time())
+		if not select.select([0], [], [], timeout)[0]:
+			# the track finished
+			record('end')
+			sys.stdout.write('EOF code: 1\n')
+			sys.stdout.flush()
+			end = None
+			continue
+		data = os.read(0, 4096)
+		if not data:
+			break
+		buf += data
+		continue
+	line, buf = buf.split('\n', 1)
+	args = shlex.split(line)
+	command = args[0] if args else None
+	if command in ('loadfile', 'stop', 'quit') and end is not None:
+		record('end')
+		sys.stdout.write('EOF code: 4\n')
+		sys.stdout.flush()
+		end = None
+	if command == 'loadfile':
+		if os.path.exists(args[1]):
+			record('start')
+			end = time.time() + length
+		else:
+			failed(args[1])
+	elif command == 'quit':
+		break
+'''
+
+
+def measure(backend, tracks, command, timeout):
+	"""Play the given tracks with the given backend, loading each as soon as the last finishes, as play() does.
+	Returns False if any track wasn't finished within timeout seconds."""
+	player = BACKENDS[backend](command=command)
+	stalled = object()
+	try:
+		for track in tracks:
+			if gevent.with_timeout(timeout, player.load(track, 0.5).wait, timeout_value=stalled) is stalled:
+				print "{}: stalled waiting for {}".format(backend, track)
+				return False
+	finally:
+		player.close()
+	return True
+
+
+def read_gaps(logpath):
+	"""Returns the gaps between each end and the following start in the log,
+	and the number of failed loads"""
+	gaps = []
+	failures = 0
+	ended = None
+	with open(logpath) as f:
+		for line in f:
+			event, timestamp = line.split()
+			timestamp = float(timestamp)
+			if event == 'end':
+				ended = timestamp
+			elif event == 'failed':
+				failures += 1
+				ended = None
+			elif ended is not None:
+				gaps.append(timestamp - ended)
+				ended = None
+	return gaps, failures
+
+
+@with_argv
+def main(tracks=50, length=0.1, missing=10):
+	tracks, length, missing = int(tracks), float(length), int(missing)
+	tempdir = tempfile.mkdtemp(prefix='awp-gap-')
+	stalled = False
+	try:
+		command = os.path.join(tempdir, 'mplayer')
+		with open(command, 'w') as f:
+			f.write(FAKE_MPLAYER.format(python=sys.executable))
+		os.chmod(command, stat.S_IRWXU)
+		paths = []
+		for i in xrange(tracks):
+			path = os.path.join(tempdir, 'track {}.mp3'.format(i))
+			if not (missing and i % missing == missing - 1):
+				open(path, 'w').close()
+			paths.append(path)
+		os.environ['FAKE_MPLAYER_LENGTH'] = str(length)
+		for backend in sorted(BACKENDS):
+			logpath = os.path.join(tempdir, '{}.log'.format(backend))
+			os.environ['FAKE_MPLAYER_LOG'] = logpath
+			if not measure(backend, paths, command, timeout=length + 5):
+				stalled = True
+				continue
+			gaps, failures = read_gaps(logpath)
+			gaps.sort()
+			print "{}: {} gaps, mean {:.2f}ms, median {:.2f}ms, max {:.2f}ms, skipped {} missing files".format(
+				backend, len(gaps), 1000 * sum(gaps) / len(gaps), 1000 * gaps[len(gaps) / 2], 1000 * gaps[-1],
+				failures)
+	finally:
+		shutil.rmtree(tempdir)
+	if stalled:
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,55 @@
+
+"""Compares the memory used by a playlist's entries when stored as an OrderedDict of tuples
+(the old representation) and as an Entries object.
+Usage:
+	python -m awp.benchmark.memory [--count N]
+Each representation is built in a separate forked process, which reports its growth in resident memory.
+"""
+
+import os
+from collections import OrderedDict
+from multiprocessing import Process, Queue
+
+from scriptlib import with_argv
+
+from awp.entries import Entries
+from awp.benchmark.synthetic import synthetic_paths
+
+
+def rss():
+	"""Current resident memory of this process in bytes"""
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(factory, count, results):
+	# build paths first, so we only measure the cost of the structure itself
+	paths = list(synthetic_paths(count))
+	before = rss()
+	entries = factory()
+	for path in paths:
+		entries[path] = (16.0, 0.5)
+	results.put(rss() - before)
+
+
+REPRESENTATIONS = [
+	('OrderedDict', OrderedDict),
+	('Entries', Entries),
+]
+
+
+@with_argv
+def main(count=1000000):
+	count = int(count)
+	for name, factory in REPRESENTATIONS:
+		results = Queue()
+		proc = Process(target=measure, args=(factory, count, results))
+		proc.start()
+		used = results.get()
+		proc.join()
+		print "{:>12}: {:8.1f} MiB for {} entries ({:.1f} bytes/entry, excluding path strings)".format(
+			name, used / 2.**20, count, float(used) / count)
+
+
+if __name__ == '__main__':
+	main()
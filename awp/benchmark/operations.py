@@ -0,0 +1,143 @@
+
+"""Times common playlist operations on synthetic playlists of various sizes.
+Usage:
+	python -m awp.benchmark.operations
+Also takes optional --options as follows:
+	--sizes N,N,...: Playlist sizes to benchmark. Defaults to 1000,100000,1000000.
+	--repeat N: Number of times to run each benchmark. The fastest run is reported. Default 3.
+	--tree-limit N: Most files to create on disk for the from_directory benchmark. Default 100000.
+	--output FILE: Write results as JSON to FILE. Otherwise they are written to stdout.
+	--baseline FILE: Compare results to a previous run's output, and exit with status 1
+	                 if any operation is slower than in the baseline by more than the threshold.
+	--threshold X: Allowed slowdown as a fraction, default 0.2 (ie. 20%).
+Results are seconds per operation. Progress and comparisons are printed to stderr.
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+from scriptlib import with_argv
+
+from awp.playlist import Playlist, from_directory
+from awp.benchmark.synthetic import synthetic_playlist, synthetic_tree
+
+CALLS = 10000 # number of calls to make for per-call operations (next, update)
+
+
+def timed(func, setup=lambda: None, repeat=3, calls=1):
+	"""Returns the fastest time of repeat runs of func(setup()), divided by calls.
+	setup is not included in the time."""
+	best = None
+	for _ in xrange(repeat):
+		arg = setup()
+		start = timer()
+		func(arg)
+		elapsed = timer() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best / calls
+
+
+def benchmark(size, repeat=3, tree_limit=100000, tempdir=None):
+	"""Run all benchmarks for the given playlist size. Returns a dict {operation: seconds}."""
+	results = {}
+	playlist = synthetic_playlist(size)
+	paths = playlist.entries.keys()
+	rng = random.Random(0)
+
+	def run(name, *args, **kwargs):
+		sys.stderr.write('{:>9} {:<18}'.format(size, name))
+		sys.stderr.flush()
+		results[name] = timed(*args, repeat=repeat, **kwargs)
+		sys.stderr.write('{:.6g}s\n'.format(results[name]))
+
+	filepath = os.path.join(tempdir, 'playlist')
+	run('writefile', lambda _: playlist.writefile(filepath))
+	run('readfile', lambda _: Playlist(filepath))
+
+	def do_next(_):
+		for _ in xrange(CALLS):
+			playlist.next()
+	run('next', do_next, calls=CALLS)
+
+	# updates are done on a copy, so that they don't affect weights for later benchmarks
+	def do_update((copy, targets)):
+		for path in targets:
+			copy.update(path, weight=lambda x: x * 2)
+	run('update', do_update, lambda: (playlist.copy(), [rng.choice(paths) for _ in xrange(CALLS)]), calls=CALLS)
+
+	# another playlist, as if from another machine: 1% changed, 1% added, 1% removed
+	other = playlist.copy()
+	for path in rng.sample(paths, size // 100):
+		other.update(path, weight=lambda x: x / 2)
+	for path in rng.sample(paths, size // 100):
+		other.remove_item(path)
+	for path in synthetic_playlist(size // 100, seed=1, root='/mnt/other').entries:
+		other.add_item(path, 16, 0.5)
+	run('diff', lambda _: playlist.diff(other))
+	run('merge', lambda copy: copy.merge(other), playlist.copy)
+
+	run('to_repeated_list', lambda _: playlist.to_repeated_list())
+
+	tree = os.path.join(tempdir, 'tree')
+	synthetic_tree(tree, min(size, tree_limit))
+	try:
+		run('from_directory', lambda _: from_directory(tree, use_magic=False))
+	finally:
+		shutil.rmtree(tree)
+
+	return results
+
+
+def compare(results, baseline, threshold):
+	"""Compare results against baseline results, printing a line for each operation in both.
+	Returns a list of (size, operation, ratio) for each operation that regressed past threshold."""
+	regressions = []
+	for size, operations in sorted(results.items(), key=lambda (size, ops): int(size)):
+		for name, seconds in sorted(operations.items()):
+			old = baseline.get(size, {}).get(name)
+			if not old:
+				continue
+			ratio = seconds / old
+			regressed = ratio > 1 + threshold
+			if regressed:
+				regressions.append((size, name, ratio))
+			sys.stderr.write('{:>9} {:<18}{:>7.2f}x{}\n'.format(size, name, ratio, ' REGRESSION' if regressed else ''))
+	return regressions
+
+
+@with_argv
+def main(sizes='1000,100000,1000000', repeat=3, tree_limit=100000, output=None, baseline=None, threshold=0.2):
+	tempdir = tempfile.mkdtemp(prefix='awp-benchmark-')
+	try:
+		results = {size: benchmark(int(size), int(repeat), int(tree_limit), tempdir) for size in sizes.split(',')}
+	finally:
+		shutil.rmtree(tempdir)
+
+	data = json.dumps({
+		'time': time.time(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'results': results,
+	}, indent=4, sort_keys=True) + '\n'
+	if output:
+		with open(output, 'w') as f:
+			f.write(data)
+	else:
+		sys.stdout.write(data)
+
+	if baseline:
+		with open(baseline) as f:
+			baseline = json.load(f)['results']
+		if compare(results, baseline, float(threshold)):
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,61 @@
+
+"""Generators for synthetic playlists and directory trees to benchmark against."""
+
+import os
+import random
+
+from awp.playlist import Playlist
+
+
+WORDS = ('the love night blue heart fire dance girl time dream world light dark rain song home road '
+         'day city wild gold sun moon star river summer cold eyes black white sweet broken lonely '
+         'electric midnight forever paradise yesterday tomorrow revolution symphony').split()
+EXTENSIONS = ('flac', 'mp3', 'mp3', 'mp3', 'ogg', 'm4a')
+
+
+def _name(rng, lower, upper):
+	return ' '.join(rng.choice(WORDS).capitalize() for _ in xrange(rng.randint(lower, upper)))
+
+
+def synthetic_paths(count, seed=0, root='/mnt/music'):
+	"""Generate count distinct paths of the form ROOT/ARTIST/ALBUM/NN - TITLE.EXT,
+	with about 12 tracks per album and a few albums per artist."""
+	rng = random.Random(seed)
+	seen = set()
+	while len(seen) < count:
+		artist = _name(rng, 1, 3)
+		for _ in xrange(rng.randint(1, 6)):
+			album = _name(rng, 1, 4)
+			for track in xrange(1, rng.randint(8, 16)):
+				path = os.path.join(root, artist, album, '{:02d} - {}.{}'.format(
+					track, _name(rng, 1, 6), rng.choice(EXTENSIONS)))
+				if path in seen:
+					continue
+				seen.add(path)
+				yield path
+				if len(seen) == count:
+					return
+
+
+def synthetic_weight(rng, weight=16):
+	"""A weight as it might be after some history of promotions and demotions (which double or halve)"""
+	return weight * 2 ** max(-3, min(3, int(round(rng.gauss(0, 1)))))
+
+
+def synthetic_playlist(count, seed=0, root='/mnt/music'):
+	"""Generate a Playlist of count entries with realistic weights and volumes."""
+	rng = random.Random(seed)
+	playlist = Playlist()
+	for path in synthetic_paths(count, seed, root):
+		volume = 0.5 if rng.random() < 0.9 else round(rng.uniform(0.2, 1), 2)
+		playlist.add_item(path, synthetic_weight(rng), volume, warn=False)
+	return playlist
+
+
+def synthetic_tree(root, count, seed=0):
+	"""Create a directory tree under root containing count empty audio files."""
+	for path in synthetic_paths(count, seed, root):
+		directory = os.path.dirname(path)
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		open(path, 'w').close()
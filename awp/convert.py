@@ -0,0 +1,19 @@
+
+"""Tool to convert a playlist between the text and binary formats"""
+
+from argh import dispatch_command, arg
+
+from playlist import Playlist
+
+
+@arg('--format', choices=['text', 'binary'], help='format to write. Defaults to the opposite of the input format')
+def main(playlist, output, format=None):
+	"""Reads the playlist and writes it to output in the given format."""
+	playlist = Playlist(playlist)
+	if not format:
+		format = 'binary' if playlist.format == 'text' else 'text'
+	playlist.writefile(output, format=format)
+
+
+if __name__=='__main__':
+	dispatch_command(main)
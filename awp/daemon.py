@@ -0,0 +1,376 @@
+
+"""A long-running player, controlled over a UNIX socket instead of the terminal.
+
+The playlist is kept in memory. Changes to it (by promoting, demoting or changing volume) take
+effect immediately in memory, but are only written out periodically, coalescing all changes
+made since the last write. Writes happen in a background thread, so playback never waits on them.
+
+Start the daemon with:
+	python -m awp.daemon run PLAYLIST [--socket PATH]
+then control it with:
+	python -m awp.daemon send COMMAND [--socket PATH]
+Commands are as follows:
+	promote: Double the weight of the current track.
+	demote: Halve the weight of the current track.
+	skip: Skip the current track and demote it.
+	next: Skip the current track without demoting it.
+	volume up|down: Change the volume of the current track, also persisting it.
+	status: Show the current track and state as JSON.
+	flush: Write any unsaved changes now.
+	quit: Stop playing, write any unsaved changes and exit.
+The protocol is one command per line, with each command receiving a one-line response,
+either "ok" followed by any output, or "error" followed by a message.
+"""
+
+import errno
+import json
+import logging
+import os
+import socket
+import time
+
+import gevent
+import gevent.lock
+import gevent.socket
+from gevent.event import Event
+from gevent.server import StreamServer
+
+import argh
+
+from play import clamp, log_config, set_lastfm, scrobble_lastfm
+from playlist import Playlist
+from players import BACKENDS
+from lastfm import LastFM
+from metadata import MetadataCache
+from instrument import Stats, monotonic
+from prefetch import Prefetcher
+
+DEFAULT_SOCKET = os.path.expanduser('~/.awp.sock')
+
+
+class Daemon(object):
+	"""Plays a playlist forever (or until quit), taking commands from a UNIX socket at socket_path.
+	Changes are written out every flush_interval seconds, if there are any, at which point
+	changes made to the file by others are also picked up. If there is nothing to play (no entries
+	with a positive weight), it waits for changes like these until there is.
+	backend, journal, lastfm, metadata, stats and prefetch_budget are as per play.play().
+	"""
+
+	VOLUME_STEP = 0.03
+
+	def __init__(self, playlist, socket_path=DEFAULT_SOCKET, backend='slave', journal=False,
+	             flush_interval=30, lastfm=None, metadata=None, stats=None, prefetch_budget=8 * 1024 * 1024):
+		if isinstance(playlist, basestring):
+			playlist = Playlist(playlist)
+		self.playlist = playlist
+		self.journal = journal
+		self.playlist.journal = journal
+		self.socket_path = socket_path
+		self.flush_interval = flush_interval
+		self.lastfm = lastfm
+		self.metadata = MetadataCache(metadata) if isinstance(metadata, basestring) else metadata
+		self.stats = stats if isinstance(stats, Stats) else Stats(stats)
+		self.prefetcher = Prefetcher(prefetch_budget, self.stats)
+
+		self.vol_max = int(os.environ.get('VOL_MAX', 2))
+		self.vol_fudge = float(os.environ.get('VOL_FUDGE', 1)) # disables persistent volume changes if not 1
+		if isinstance(backend, basestring):
+			backend = BACKENDS[backend]
+		self.player = backend(vol_max=self.vol_max, vol_fudge=self.vol_fudge)
+
+		self.socket_inode = None # of the socket we created at socket_path, see _listen()
+		self.current = None # (filename, volume) of the current track
+		self.current_weight_changed = False # by a command while the current track plays, see run()
+		self.started = None
+		self.changes = {} # {path: [weight multiplier, new volume or None]} not yet written
+		self.flush_lock = gevent.lock.Semaphore()
+		self.stopping = Event()
+
+	# Commands
+
+	def cmd_promote(self):
+		self.change_weight(2)
+
+	def cmd_demote(self):
+		self.change_weight(0.5)
+
+	def cmd_skip(self):
+		self.change_weight(0.5)
+		self.stats.count('skips')
+		self.player.skip()
+
+	def cmd_next(self):
+		self.player.skip()
+
+	def cmd_volume(self, direction):
+		if direction not in ('up', 'down'):
+			raise ValueError("Volume must be up or down")
+		filename, volume = self.current
+		change = self.VOLUME_STEP * self.vol_max * (1 if direction == 'up' else -1)
+		volume = clamp(0, volume + change, 1)
+		self.current = filename, volume
+		# mplayer's own volume keys, so it takes effect immediately
+		self.player.send('*' if direction == 'up' else '/')
+		if self.vol_fudge == 1:
+			self.change(filename, volume=volume)
+
+	def cmd_status(self):
+		filename, volume = self.current
+		return json.dumps({
+			'filename': filename,
+			'volume': volume,
+			'weight': self.playlist.entries[filename][0] if filename in self.playlist.entries else None,
+			'elapsed': time.time() - self.started,
+			'unsaved': len(self.changes),
+			'stats': self.stats.snapshot(),
+		})
+
+	def cmd_flush(self):
+		self.flush()
+
+	def cmd_quit(self):
+		self.stopping.set()
+		self.player.skip()
+
+	# Changes and persistence
+
+	def change_weight(self, multiplier):
+		filename, volume = self.current
+		self.change(filename, multiplier=multiplier)
+		self.current_weight_changed = True
+		self.stats.count('promotions' if multiplier > 1 else 'demotions')
+
+	def change(self, path, multiplier=1, volume=None):
+		"""Apply a change in memory now, and remember it to be written at the next flush"""
+		if path not in self.playlist.entries:
+			return
+		self.playlist.update(path, weight=lambda x: x * multiplier, volume=volume)
+		pending = self.changes.setdefault(path, [1, None])
+		pending[0] *= multiplier
+		if volume is not None:
+			pending[1] = volume
+
+	def flush(self):
+		"""Write out any changes, and pick up any changes made to the file by others.
+		The file is read and written in a background thread, on a fresh copy of the playlist,
+		which then replaces our copy along with any changes made in the meantime."""
+		with self.flush_lock:
+			if not self.changes and not self.playlist.changed_on_disk():
+				return
+			changes, self.changes = self.changes, {}
+			start = monotonic()
+			try:
+				playlist = gevent.get_hub().threadpool.apply(self._write, (self.playlist.filepath, changes))
+			except Exception:
+				logging.warning("Failed to write playlist, will retry", exc_info=True)
+				for path, (multiplier, volume) in changes.items():
+					if path in self.changes:
+						self.changes[path][0] *= multiplier
+						if self.changes[path][1] is None:
+							self.changes[path][1] = volume
+					else:
+						self.changes[path] = [multiplier, volume]
+				return
+			# re-apply anything that changed while we were writing
+			for path, (multiplier, volume) in self.changes.items():
+				if path in playlist.entries:
+					playlist.update(path, weight=lambda x, multiplier=multiplier: x * multiplier, volume=volume)
+			self.playlist = playlist
+			self.stats.record('flush', monotonic() - start)
+			self.stats.count('flushes' if changes else 'reloads')
+
+	def _write(self, filepath, changes):
+		"""Runs in a thread. Applies changes to a freshly read copy of the file, and writes them.
+		If there are no changes, the file is only read, as writing it anyway would look like
+		a change to anyone else sharing it, who would then write it back, and so on forever."""
+		playlist = Playlist(filepath, journal=self.journal)
+		if not changes:
+			return playlist
+		for path, (multiplier, volume) in changes.items():
+			if path in playlist.entries:
+				playlist.update(path, weight=lambda x, multiplier=multiplier: x * multiplier, volume=volume)
+		playlist.save()
+		return playlist
+
+	def _flush_periodically(self):
+		while True:
+			self.stopping.wait(self.flush_interval)
+			if self.stopping.is_set():
+				return
+			try:
+				self.flush()
+			except Exception:
+				logging.exception("Error while flushing")
+
+	# Control socket
+
+	def _listen(self):
+		"""Returns a listening socket at socket_path, replacing it if no-one is listening on it.
+		Raises ValueError if another daemon is already listening there."""
+		probe = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(self.socket_path)
+		except socket.error as e:
+			if e.errno == errno.ECONNREFUSED:
+				os.remove(self.socket_path) # left behind by a daemon which didn't exit cleanly
+			elif e.errno != errno.ENOENT:
+				raise
+		else:
+			raise ValueError("Another daemon is already running on {}".format(self.socket_path))
+		finally:
+			probe.close()
+		sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.bind(self.socket_path)
+		sock.listen(16)
+		self.socket_inode = os.stat(self.socket_path).st_ino
+		return sock
+
+	def _unlisten(self):
+		"""Remove the socket at socket_path, unless it has since been replaced by someone else's"""
+		try:
+			if os.stat(self.socket_path).st_ino == self.socket_inode:
+				os.remove(self.socket_path)
+		except OSError as e:
+			if e.errno != errno.ENOENT: raise
+
+	def _handle(self, sock, address):
+		f = sock.makefile()
+		try:
+			for line in iter(f.readline, ''):
+				args = line.split()
+				if not args:
+					continue
+				command = getattr(self, 'cmd_{}'.format(args[0]), None)
+				try:
+					if command is None:
+						raise ValueError("Unknown command: {}".format(args[0]))
+					result = command(*args[1:])
+				except Exception as e:
+					logging.info("Command {!r} failed".format(line), exc_info=True)
+					response = 'error {}'.format(e)
+				else:
+					response = 'ok' if result is None else 'ok {}'.format(result)
+				f.write(response + '\n')
+				f.flush()
+		except socket.error as e:
+			if e.errno not in (errno.EPIPE, errno.ECONNRESET): raise
+		finally:
+			f.close()
+			sock.close()
+
+	# Playback
+
+	def start_track(self, filename, volume):
+		logging.info("Playing {!r} at {}".format(filename, volume))
+		if self.lastfm:
+			gevent.spawn(set_lastfm, self.lastfm, filename, self.metadata)
+		self.current = filename, volume
+		self.current_weight_changed = False
+		self.stats.count('tracks')
+		self.prefetcher.started(filename)
+		with self.stats.time('start'):
+			return self.player.load(filename, volume)
+
+	def choose(self):
+		"""Returns the next (filename, volume) to play. If there's nothing to play, waits for the playlist
+		to be changed (see flush()) until there is. Returns None if told to quit in the meantime."""
+		warned = False
+		while not self.stopping.is_set():
+			with self.stats.time('choose'):
+				try:
+					return self.playlist.next()
+				except ValueError as e:
+					if not warned:
+						logging.warning("Nothing to play, waiting for changes to the playlist: {}".format(e))
+						warned = True
+			self.stopping.wait(self.flush_interval)
+		return None
+
+	def run(self):
+		server = StreamServer(self._listen(), self._handle)
+		server.start()
+		flusher = gevent.spawn(self._flush_periodically)
+		try:
+			current = self.choose()
+			if current is None:
+				return
+			filename, volume = current
+			track = self.start_track(filename, volume)
+			self.started = time.time()
+			while True:
+				upcoming = self.choose()
+				if upcoming is None:
+					break
+				self.prefetcher.prefetch(upcoming[0])
+				track.wait()
+				if self.stopping.is_set():
+					break
+				ended = time.time()
+				exited = monotonic()
+				if self.current_weight_changed:
+					# upcoming was chosen with this track's old weight, so eg. a track that was
+					# just skipped could be chosen to play again straight away. Choose again.
+					upcoming = self.choose()
+					if upcoming is None:
+						break
+				track = self.start_track(*upcoming)
+				self.stats.record('gap', monotonic() - exited)
+				if self.lastfm:
+					gevent.spawn(scrobble_lastfm, self.lastfm, filename, self.started, ended, self.metadata)
+				filename, volume = upcoming
+				self.started = ended
+		finally:
+			self.stopping.set()
+			server.stop()
+			self._unlisten()
+			self.player.close()
+			flusher.join()
+			self.flush()
+			self.stats.write()
+			if self.lastfm and not self.lastfm.flush(timeout=5):
+				logging.warning("Exiting with lastfm submissions still queued")
+
+
+@argh.arg('--flush-interval', type=float, help='seconds between writes of changes to the playlist')
+@argh.arg('--prefetch-budget', type=int, help='bytes to read ahead from the start of the next track. 0 to disable.')
+def run(playlist, socket=DEFAULT_SOCKET, backend='slave', journal=False, flush_interval=30,
+        lastfm_creds=None, metadata_cache=None, stats_file=None, prefetch_budget=8 * 1024 * 1024,
+        loglevel='WARNING', logfile='/tmp/awp', logfilelevel='DEBUG'):
+	"""Run the player until told to quit"""
+	log_config(loglevel, logfile, logfilelevel)
+	lastfm = None
+	if lastfm_creds:
+		with open(lastfm_creds) as f:
+			lastfm = LastFM(**json.load(f))
+	Daemon(playlist, socket, backend=backend, journal=journal, flush_interval=flush_interval,
+	       lastfm=lastfm, metadata=metadata_cache, stats=stats_file, prefetch_budget=prefetch_budget).run()
+
+
+def send(socket_path, *command):
+	"""Send a command to a running daemon. Returns its output, or raises ValueError on error."""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path)
+		f = sock.makefile()
+		f.write('{}\n'.format(' '.join(command)))
+		f.flush()
+		response = f.readline().rstrip('\n')
+	finally:
+		sock.close()
+	status, _, output = response.partition(' ')
+	if status != 'ok':
+		raise ValueError(output or "No response")
+	return output
+
+
+@argh.named('send')
+@argh.arg('command', nargs='+')
+def send_command(command, socket=DEFAULT_SOCKET):
+	"""Send a command to a running player"""
+	output = send(socket, *command)
+	if output:
+		print output
+
+
+if __name__ == '__main__':
+	argh.dispatch_commands([run, send_command])
@@ -0,0 +1,218 @@
+from rand import WeightedIndex
+from array import array
+from collections import MutableMapping
+from itertools import izip
+import random
+
+
+class Entries(MutableMapping):
+	"""An ordered mapping of { path : (weight, volume) }, which behaves like an OrderedDict
+	but is stored compactly as columns.
+
+	Paths are kept in a list, with a dict mapping each path to its position,
+	and weights and volumes are kept in parallel array('d') columns.
+	Removing an entry leaves a gap (a path of None with 0 weight) in the columns,
+	which are compacted once gaps make up more than half of them.
+	Code which works directly on the columns should skip these gaps.
+
+	Operations on a whole directory tree (see rewrite_prefix(), iter_under() and drop_subtree())
+	find the paths under it in a single pass over the paths column.
+
+	Entries also maintains an index for choosing a path at random by weight, see choice().
+	"""
+
+	COMPACT_MIN = 1024 # don't bother compacting for fewer gaps than this
+
+	def __init__(self, items=()):
+		self.paths = []
+		self.positions = {}
+		self.weights = array('d')
+		self.volumes = array('d')
+		self._gaps = 0
+		self._index = None # WeightedIndex over self.weights, built on demand by choice()
+		self.update(items)
+
+	def position(self, path):
+		"""Returns the position of path in the columns, or None if it isn't present"""
+		return self.positions.get(path)
+
+	def path_at(self, i):
+		"""Returns the path at position i in the columns, or None for a gap"""
+		return self.paths[i]
+
+	def __len__(self):
+		return len(self.positions)
+
+	def __contains__(self, path):
+		return path in self.positions
+
+	def __iter__(self):
+		return (path for path in self.paths if path is not None)
+
+	def __getitem__(self, path):
+		i = self.positions[path]
+		return self.weights[i], self.volumes[i]
+
+	def __setitem__(self, path, value):
+		weight, volume = value
+		i = self.positions.get(path)
+		if i is None:
+			self.positions[path] = len(self.paths)
+			self.paths.append(path)
+			self.volumes.append(volume)
+			if self._index is None:
+				self.weights.append(weight)
+			else:
+				self._index.append(weight) # also appends to self.weights
+		else:
+			self.volumes[i] = volume
+			if self._index is None:
+				self.weights[i] = weight
+			else:
+				self._index[i] = weight # also sets self.weights[i]
+
+	def __delitem__(self, path):
+		i = self.positions.pop(path)
+		self.paths[i] = None
+		self.volumes[i] = 0
+		if self._index is None:
+			self.weights[i] = 0
+		else:
+			self._index[i] = 0
+		self._gaps += 1
+		if self._gaps > self.COMPACT_MIN and self._gaps > len(self.positions):
+			self.compact()
+
+	def clear(self):
+		self.__init__()
+
+	def iteritems(self):
+		return ((path, (weight, volume)) for path, weight, volume
+		        in izip(self.paths, self.weights, self.volumes) if path is not None)
+
+	def itervalues(self):
+		return ((weight, volume) for path, weight, volume
+		        in izip(self.paths, self.weights, self.volumes) if path is not None)
+
+	def items(self):
+		return list(self.iteritems())
+
+	def values(self):
+		return list(self.itervalues())
+
+	def extend(self, paths, weights, volumes):
+		"""Add many new entries at once, given as parallel sequences.
+		The paths must not already be present (or repeated), otherwise ValueError."""
+		start = len(self.paths)
+		added = dict(izip(paths, xrange(start, start + len(paths))))
+		if len(added) != len(paths) or self.positions.viewkeys() & added.viewkeys():
+			raise ValueError("Paths to extend with are repeated or already present")
+		if self.positions:
+			self.positions.update(added)
+		else:
+			self.positions = added
+		self.paths.extend(paths)
+		self.weights = _extend_column(self.weights, weights)
+		self.volumes = _extend_column(self.volumes, volumes)
+		self._index = None
+
+	def compact(self):
+		"""Remove any gaps left in the columns by removed entries."""
+		if not self._gaps:
+			return
+		keep = [i for i, path in enumerate(self.paths) if path is not None]
+		self.paths = [self.paths[i] for i in keep]
+		self.weights = array('d', (self.weights[i] for i in keep))
+		self.volumes = array('d', (self.volumes[i] for i in keep))
+		self.positions = {path: i for i, path in enumerate(self.paths)}
+		self._gaps = 0
+		self._index = None
+
+	def copy(self):
+		result = Entries()
+		result.paths = list(self.paths)
+		result.positions = self.positions.copy()
+		result.weights = array('d', self.weights)
+		result.volumes = array('d', self.volumes)
+		result._gaps = self._gaps
+		return result
+
+	def set_columns(self, weights=None, volumes=None):
+		"""Replace the weights or volumes column (or both) with a new array('d') of the same length.
+		Gaps must keep a weight of 0."""
+		if weights is not None:
+			if len(weights) != len(self.weights):
+				raise ValueError("Expected {} weights, got {}".format(len(self.weights), len(weights)))
+			self.weights = weights
+			self._index = None
+		if volumes is not None:
+			if len(volumes) != len(self.volumes):
+				raise ValueError("Expected {} volumes, got {}".format(len(self.volumes), len(volumes)))
+			self.volumes = volumes
+
+	def positions_under(self, directory):
+		"""Returns a list of the positions in the columns of each path under the given directory"""
+		prefix = directory.rstrip('/') + '/'
+		return [i for i, path in enumerate(self.paths) if path is not None and path.startswith(prefix)]
+
+	def iter_under(self, directory):
+		"""Yields each path under the given directory, in order"""
+		return (self.path_at(i) for i in self.positions_under(directory))
+
+	def drop_subtree(self, directory):
+		"""Remove all paths under the given directory. Returns the number removed."""
+		paths = list(self.iter_under(directory))
+		for path in paths:
+			del self[path]
+		return len(paths)
+
+	def rewrite_prefix(self, src, dest):
+		"""Move every path under directory src to be under directory dest instead, keeping order.
+		If this would make two entries have the same path, raises ValueError without changing anything.
+		Returns the number of paths rewritten.
+		"""
+		src = src.rstrip('/') + '/'
+		dest = dest.rstrip('/') + '/' if dest else ''
+		moved = self.positions_under(src)
+		new_paths = [dest + self.paths[i][len(src):] for i in moved]
+		moving = set(moved)
+		for path in new_paths:
+			i = self.positions.get(path)
+			if i is not None and i not in moving:
+				raise ValueError("Rewriting {!r} to {!r} would overwrite {!r}".format(src, dest, path))
+		for i in moved:
+			del self.positions[self.paths[i]]
+		for i, path in izip(moved, new_paths):
+			self.positions[path] = i
+			self.paths[i] = path
+		return len(moved)
+
+	def total(self):
+		"""Total weight of all entries"""
+		return self._get_index().total
+
+	def choice(self, random=random.random):
+		"""Choose a path at random, weighted by its weight, in O(log n).
+		Raises IndexError if there are no entries with a positive weight."""
+		return self.path_at(self.choice_position(random))
+
+	def choice_position(self, random=random.random):
+		"""As per choice(), but returns the chosen position in the columns instead of the path"""
+		return self._get_index().choice(random)
+
+	def _get_index(self):
+		if self._index is None:
+			self._index = WeightedIndex(self.weights)
+		return self._index
+
+	def __repr__(self):
+		return "Entries({!r})".format(self.items())
+
+
+def _extend_column(column, values):
+	"""Returns column extended by values. If column is empty and values is already
+	a suitable array, it is returned as-is to avoid a copy."""
+	if not column and isinstance(values, array) and values.typecode == column.typecode:
+		return values
+	column.extend(values)
+	return column
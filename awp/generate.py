@@ -1,16 +1,38 @@
 
-"""Tool to print a list of files, generated randomly from a playlist."""
+"""Tool to print a list of files, generated randomly from a playlist.
+Usage:
+	python -m awp.generate PLAYLIST
+Also takes optional --options as follows:
+	--count N: Stop after N files. Otherwise, prints forever (or with --unique, until all are used).
+	--unique: Do not print any file more than once.
+	--seed SEED: Integer seed for the random choices, for repeatable output.
+"""
 
 import errno
+import itertools
 
 from scriptlib import with_argv
 from playlist import Playlist
 
+BATCH_SIZE = 4096
+
 @with_argv
-def main(playlist):
-	"""TODO: Add unique option, add limit option"""
+def main(playlist, count=None, unique=False, seed=None):
 	playlist = Playlist(playlist)
-	for path, volume in playlist:
+	if count is not None:
+		count = int(count)
+	if seed is not None:
+		seed = int(seed)
+
+	if unique:
+		paths = [path for path, volume in playlist.sample(len(playlist.entries) if count is None else count,
+		                                                  unique=True, seed=seed)]
+	elif count is not None:
+		paths = [path for path, volume in playlist.sample(count, seed=seed)]
+	else:
+		paths = generate(playlist, seed)
+
+	for path in paths:
 		try:
 			print path
 		except (OSError, IOError) as e:
@@ -19,5 +41,17 @@ def main(playlist):
 			raise
 
 
+def generate(playlist, seed=None):
+	"""Yields paths forever, choosing them in batches."""
+	for batch in itertools.count():
+		# derive a distinct but repeatable seed for each batch
+		batch_seed = None if seed is None else hash((seed, batch)) & 0xffffffff
+		picks = playlist.sample(BATCH_SIZE, seed=batch_seed)
+		if not picks:
+			return
+		for path, volume in picks:
+			yield path
+
+
 if __name__=='__main__':
 	main()
@@ -0,0 +1,78 @@
+
+"""Lightweight timings and counters, for seeing where time goes in long-running loops like the player."""
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+try:
+	from time import monotonic
+except ImportError:
+	try:
+		from monotonic import monotonic
+	except ImportError:
+		# not actually monotonic, but close enough if nothing better is available
+		from time import time as monotonic
+
+
+class Stats(object):
+	"""Records counters and timings. Each event is logged at DEBUG level,
+	and each timing is summarised as a count, total, max and last value so memory use is constant.
+	If filepath is given, write() saves a JSON snapshot there (see snapshot()).
+	"""
+
+	def __init__(self, filepath=None, logger=None):
+		self.filepath = filepath
+		self.logger = logger or logging.getLogger(__name__)
+		self.started = monotonic()
+		self.counters = {}
+		self.timings = {}
+
+	def count(self, name, n=1):
+		self.counters[name] = self.counters.get(name, 0) + n
+		self.logger.debug("{}: {}".format(name, self.counters[name]))
+
+	def record(self, name, duration):
+		"""Record a timing in seconds"""
+		count, total, longest, last = self.timings.get(name, (0, 0, 0, None))
+		self.timings[name] = count + 1, total + duration, max(longest, duration), duration
+		self.logger.debug("{} took {:.6f}s".format(name, duration))
+
+	@contextmanager
+	def time(self, name):
+		"""Context manager that records a timing for the enclosed block"""
+		start = monotonic()
+		yield
+		self.record(name, monotonic() - start)
+
+	def snapshot(self):
+		"""Returns a dict of the current counters and timings, suitable for JSON."""
+		return {
+			'time': time.time(),
+			'uptime': monotonic() - self.started,
+			'counters': dict(self.counters),
+			'timings': {
+				name: {
+					'count': count,
+					'total': total,
+					'mean': total / count,
+					'max': longest,
+					'last': last,
+				} for name, (count, total, longest, last) in self.timings.items()
+			},
+		}
+
+	def write(self):
+		"""Atomically write a snapshot to filepath, if set"""
+		if not self.filepath:
+			return
+		dirname, basename = os.path.split(self.filepath)
+		tmppath = os.path.join(dirname, '.{}.tmp'.format(basename))
+		try:
+			with open(tmppath, 'w') as f:
+				json.dump(self.snapshot(), f, indent=4, sort_keys=True)
+			os.rename(tmppath, self.filepath)
+		except (OSError, IOError):
+			self.logger.warning("Failed to write stats to {!r}".format(self.filepath), exc_info=True)
@@ -1,37 +1,49 @@
 
-import functools
+import json
 import md5
+import os
 import time
 import logging
 
+import gevent
+from gevent.event import Event
 import requests
 
 
-def ratelimited(cooldown):
-	"""Decorator preventing wrapped fn from being called less than cooldown seconds
-	after the previous call. Returns None if the function isn't run."""
-	def _ratelimited(fn):
-		last_called = [None] # inside a list to allow assignment (py2 has no nonlocal keyword)
-		@functools.wraps(fn)
-		def _wrapper(*a, **k):
-			if last_called[0] is None or time.time() - last_called[0] > cooldown:
-				last_called[0] = time.time()
-				return fn(*a, **k)
-		return _wrapper
-	return _ratelimited
-
-
 class LastFM(object):
+	"""Client for the last.fm API.
+	Now playing updates and scrobbles are queued, and submitted in the background by a worker greenlet
+	using a single pooled HTTP session:
+		Now playing updates are sent at most once per COOLDOWN seconds. If several are made within
+		that time, only the latest is sent.
+		Scrobbles are sent in batches of up to BATCH_SIZE. If spool is given, queued scrobbles are also
+		kept in that file, so any that can't be sent (eg. because the network is down) survive restarts,
+		and are sent once we are able to.
+	url may be given to override the API endpoint, eg. for testing.
+	"""
 	URL = 'http://ws.audioscrobbler.com/2.0/'
 	COOLDOWN = 30
+	BATCH_SIZE = 50 # max scrobbles per request, as per API docs
+	RETRY_INTERVAL = 60 # after a failed submission
+	RETRY_STATUSES = (408, 429) # 4xx responses that mean try again later, not that the request is bad
 
-	def __init__(self, user, session_key, api_key, api_secret):
+	def __init__(self, user, session_key, api_key, api_secret, url=None, spool=None):
 		self.user = user
 		self.session_key = session_key
 		self.api_key = api_key
 		self.api_secret = api_secret
+		self.url = url or self.URL
+		self.spool = spool
+		self.session = requests.Session()
+		self._nowplaying = None # args for latest now playing update not yet sent
+		self._last_nowplaying = None # time of last now playing update
+		self._scrobbles = self._read_spool() # list of args for each scrobble not yet sent
+		self._wakeup = Event()
+		self._idle = Event()
+		self._worker = None
+		if self._scrobbles:
+			self._start()
 
-	@ratelimited(COOLDOWN)
 	def call(self, method, post=False, **args):
 		args['method'] = method
 		args['sk'] = self.session_key
@@ -41,9 +53,9 @@ class LastFM(object):
 		args['format'] = 'json'
 		args['api_sig'] = sig
 		if post:
-			resp = requests.post(self.URL, data=args)
+			resp = self.session.post(self.url, data=args)
 		else:
-			resp = requests.get(self.URL, params=args)
+			resp = self.session.get(self.url, params=args)
 		try:
 			resp.raise_for_status()
 		except requests.HTTPError:
@@ -58,8 +70,93 @@ class LastFM(object):
 		return md5.new(s).hexdigest()
 
 	def nowplaying(self, track, artist):
-		self.call('track.updateNowPlaying', post=True, artist=artist, track=track)
-		logging.info("Successfully set {} - {} as playing".format(track, artist))
+		"""Queue a now playing update, replacing any not yet sent."""
+		self._nowplaying = dict(artist=artist, track=track)
+		self._start()
+
+	def scrobble(self, track, artist, timestamp, album=None, duration=None):
+		"""Queue a scrobble of a track which started playing at timestamp (a unix time)."""
+		scrobble = dict(artist=uni(artist), track=uni(track), timestamp=int(timestamp))
+		if album:
+			scrobble['album'] = uni(album)
+		if duration:
+			scrobble['duration'] = int(duration)
+		self._scrobbles.append(scrobble)
+		if self.spool:
+			with open(self.spool, 'a') as f:
+				f.write(json.dumps(scrobble) + '\n')
+		self._start()
+
+	def flush(self, timeout=None):
+		"""Wait until everything queued has been sent, or timeout. Returns True if everything was sent."""
+		if self._worker is None:
+			return True
+		return self._idle.wait(timeout)
+
+	def _start(self):
+		self._idle.clear()
+		self._wakeup.set()
+		if self._worker is None or self._worker.dead:
+			self._worker = gevent.spawn(self._run)
+
+	def _run(self):
+		while True:
+			self._wakeup.wait()
+			self._wakeup.clear()
+			try:
+				while self._scrobbles:
+					self._send_scrobbles()
+				if self._nowplaying:
+					if self._last_nowplaying is not None:
+						# any further updates while we wait will replace this one
+						gevent.sleep(max(0, self._last_nowplaying + self.COOLDOWN - time.time()))
+					args = self._nowplaying
+					self.call('track.updateNowPlaying', post=True, **args)
+					self._last_nowplaying = time.time()
+					if self._nowplaying is args:
+						self._nowplaying = None
+					logging.info(u"Successfully set {track} - {artist} as playing".format(**args))
+			except requests.RequestException:
+				logging.warning("Failed to submit to last.fm, retrying in {}s".format(self.RETRY_INTERVAL), exc_info=True)
+				gevent.sleep(self.RETRY_INTERVAL)
+				self._wakeup.set()
+				continue
+			if not (self._scrobbles or self._nowplaying):
+				self._idle.set()
+
+	def _send_scrobbles(self):
+		batch = self._scrobbles[:self.BATCH_SIZE]
+		args = {}
+		for i, scrobble in enumerate(batch):
+			for key, value in scrobble.items():
+				args['{}[{}]'.format(key, i)] = value
+		try:
+			self.call('track.scrobble', post=True, **args)
+		except requests.HTTPError as e:
+			status = None if e.response is None else e.response.status_code
+			if status is None or not 400 <= status < 500 or status in self.RETRY_STATUSES:
+				raise
+			# the request itself was rejected, so retrying won't help
+			logging.error("Discarding {} scrobbles rejected by last.fm".format(len(batch)))
+		else:
+			logging.info("Successfully scrobbled {} tracks".format(len(batch)))
+		del self._scrobbles[:len(batch)]
+		self._write_spool()
+
+	def _read_spool(self):
+		if not self.spool or not os.path.exists(self.spool):
+			return []
+		with open(self.spool) as f:
+			# ignore any partially written last line
+			return [json.loads(line) for line in f if line.endswith('\n')]
+
+	def _write_spool(self):
+		if not self.spool:
+			return
+		tmp_path = '{}~'.format(self.spool)
+		with open(tmp_path, 'w') as f:
+			f.write(''.join(json.dumps(scrobble) + '\n' for scrobble in self._scrobbles))
+		os.rename(tmp_path, self.spool)
 
 
 def utf8(s):
@@ -68,6 +165,8 @@ def utf8(s):
 def uni(s):
 	if isinstance(s, unicode):
 		return s
+	if not isinstance(s, str):
+		s = str(s)
 	try:
 		return s.decode('utf-8')
 	except UnicodeDecodeError:
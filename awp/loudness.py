@@ -0,0 +1,241 @@
+
+"""Set the volume of playlist entries from a measurement of how loud each track is,
+so that tracks play at a similar loudness without tuning each one by hand.
+
+Tracks are decoded with a pool of processes, and measurements are cached along with the size
+and mtime of the file, so only new or changed files are decoded on later runs.
+Two methods of measuring are supported:
+	ebur128: Integrated loudness (in LUFS) as per EBU R128, measured by ffmpeg. Used if ffmpeg is installed.
+	rms: RMS level (in dBFS) of the audio as decoded by mplayer. A cruder measure, but needs nothing extra.
+Measurements from one method aren't comparable to the other, so the cache only answers for the same method.
+
+Each track's volume is set so that a track at the target loudness gets the reference volume,
+with louder and quieter tracks scaled to match. The new volumes are combined with the existing ones
+according to --strategy:
+	update: Replace the existing volume.
+	average: Average the existing and new volumes, to respect some of any hand-tuning.
+	untouched: Only replace volumes which are still at the default given to new entries,
+	           ie. never tuned by hand.
+Only the volumes of measured entries are changed, and weights are never touched, so it's safe
+to run alongside players using the same playlist.
+
+Example:
+	python -m awp.loudness CACHE PLAYLIST --under /mnt/music/new
+"""
+
+import audioop
+import logging
+import math
+import os
+import re
+import sqlite3
+import sys
+from distutils.spawn import find_executable
+from multiprocessing import Pool
+from subprocess import Popen, PIPE
+
+import argh
+
+from playlist import Playlist, MergeStrategies
+
+
+SILENCE = -70 # ebur128 reports anything this quiet or quieter as this value
+DEFAULT_VOLUME = 0.5 # as given to new entries by from_directory
+CHUNK_SIZE = 65536
+
+
+def measure_ebur128(filepath):
+	"""Returns the integrated loudness of a file in LUFS, or None if it couldn't be measured."""
+	proc = Popen(['ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-i', filepath,
+	              '-map', '0:a:0', '-af', 'ebur128', '-f', 'null', '-'], stdout=PIPE, stderr=PIPE)
+	out, err = proc.communicate()
+	if proc.returncode:
+		raise ValueError("ffmpeg exited {}: {}".format(proc.returncode, err.strip().split('\n')[-1]))
+	matches = re.findall(r'I:\s+(-?[0-9.]+) LUFS', err)
+	if not matches:
+		return None
+	loudness = float(matches[-1]) # the last is the summary for the whole file
+	return loudness if loudness > SILENCE else None
+
+
+def measure_rms(filepath):
+	"""Returns the RMS level of a file in dBFS, or None if it couldn't be measured."""
+	sample_format = 's16le' if sys.byteorder == 'little' else 's16be'
+	proc = Popen(['mplayer', '-really-quiet', '-noconsolecontrols', '-nolirc', '-vo', 'null', '-vc', 'null',
+	              '-ao', 'pcm:fast:nowaveheader:file=/dev/stdout', '-af', 'format={}'.format(sample_format),
+	              filepath], stdout=PIPE, stderr=open(os.devnull, 'w'))
+	samples = 0
+	sum_squares = 0
+	while True:
+		chunk = proc.stdout.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		chunk = chunk[:len(chunk) - len(chunk) % 2]
+		count = len(chunk) / 2
+		samples += count
+		sum_squares += audioop.rms(chunk, 2) ** 2 * count
+	if proc.wait():
+		raise ValueError("mplayer exited {}".format(proc.returncode))
+	if not sum_squares:
+		return None
+	return 20 * math.log10(math.sqrt(sum_squares / float(samples)) / 32768)
+
+
+METHODS = {
+	'ebur128': measure_ebur128,
+	'rms': measure_rms,
+}
+
+
+def default_method():
+	return 'ebur128' if find_executable('ffmpeg') else 'rms'
+
+
+class LoudnessCache(object):
+	"""Stores loudness measurements in an SQLite database, along with the method used and
+	the size and mtime of the file measured. Entries are re-measured if the file has changed."""
+
+	def __init__(self, filepath):
+		self.db = sqlite3.connect(filepath)
+		self.db.execute("""
+			CREATE TABLE IF NOT EXISTS loudness (
+				path BLOB PRIMARY KEY,
+				size INTEGER,
+				mtime REAL,
+				method TEXT,
+				loudness REAL
+			)
+		""")
+		self.db.commit()
+
+	def lookup(self, path, method, stat=None):
+		"""Returns (found, loudness) for path. found is False if it isn't cached, is stale
+		or was measured another way. loudness may be None if the file was silent or couldn't be measured.
+		stat may be given if already known."""
+		if stat is None:
+			stat = os.stat(path)
+		row = self.db.execute(
+			"SELECT size, mtime, method, loudness FROM loudness WHERE path = ?",
+			(sqlite3.Binary(path),)
+		).fetchone()
+		if row is None or tuple(row[:3]) != (stat.st_size, stat.st_mtime, method):
+			return False, None
+		return True, row[3]
+
+	def store(self, path, stat, method, loudness, commit=True):
+		self.db.execute(
+			"INSERT OR REPLACE INTO loudness (path, size, mtime, method, loudness) VALUES (?, ?, ?, ?, ?)",
+			(sqlite3.Binary(path), stat.st_size, stat.st_mtime, method, loudness)
+		)
+		if commit:
+			self.db.commit()
+
+	def measure(self, paths, method=None, processes=None):
+		"""Returns {path: loudness} for all paths, from the cache where possible and otherwise
+		measuring them with a pool of processes and caching the result.
+		Files which can't be read or measured are logged and omitted, as are silent files."""
+		if method is None:
+			method = default_method()
+		results = {}
+		stale = []
+		for path in paths:
+			try:
+				found, loudness = self.lookup(path, method)
+			except OSError:
+				logging.warning("Could not stat {!r}".format(path), exc_info=True)
+				continue
+			if not found:
+				stale.append(path)
+			elif loudness is not None:
+				results[path] = loudness
+
+		pool = Pool(processes)
+		count = 0
+		try:
+			for path, stat, loudness in pool.imap_unordered(_measure_for_fill, [(path, method) for path in stale]):
+				if stat is None:
+					continue
+				self.store(path, stat, method, loudness, commit=False)
+				if loudness is not None:
+					results[path] = loudness
+				count += 1
+				if count % 100 == 0:
+					self.db.commit()
+					logging.info("Measured {} of {} files".format(count, len(stale)))
+		finally:
+			pool.terminate()
+			self.db.commit()
+		return results
+
+
+def _measure_for_fill(args):
+	"""Runs in a worker process. Returns (path, stat, loudness), or (path, None, None) on error."""
+	path, method = args
+	try:
+		# stat before measuring, so if the file changes while we read it the entry will be stale
+		stat = os.stat(path)
+		return path, stat, METHODS[method](path)
+	except Exception:
+		logging.warning("Failed to measure {!r}".format(path), exc_info=True)
+		return path, None, None
+
+
+def volume_for(loudness, target, reference=0.5):
+	"""The volume which makes a track of the given loudness play at the same loudness
+	as a track at target loudness played at the reference volume. Volume is a linear gain,
+	so each 20dB of difference is a factor of 10."""
+	return min(1, max(0, reference * 10 ** ((target - loudness) / 20.)))
+
+
+def median(values):
+	values = sorted(values)
+	middle = len(values) / 2
+	if len(values) % 2:
+		return values[middle]
+	return (values[middle - 1] + values[middle]) / 2.
+
+
+@argh.arg('--under', help='only change entries under this directory')
+@argh.arg('--match', help='only change entries whose path matches this regex')
+@argh.arg('--method', choices=sorted(METHODS), help='how to measure loudness. Defaults to ebur128 if ffmpeg is installed, otherwise rms.')
+@argh.arg('--target', type=float, help='loudness which gets the reference volume. Defaults to the median of the selected entries.')
+@argh.arg('--reference', type=float, help='volume given to tracks at the target loudness')
+@argh.arg('--strategy', choices=('update', 'average', 'untouched'), help='how to combine new volumes with existing ones')
+@argh.arg('--processes', type=int, help='number of files to decode at once. Defaults to number of CPUs.')
+@argh.arg('--journal', help='save changes to the journal instead of rewriting the playlist')
+@argh.arg('--output', help='write the result to this file instead of saving the playlist')
+def main(cache, playlist, under=None, match=None, method=None, target=None, reference=0.5,
+         strategy='update', processes=None, journal=False, output=None):
+	playlist = Playlist(playlist, journal=journal)
+	predicate = re.compile(match).search if match else None
+	selected = playlist.select(under=under, predicate=predicate)
+
+	results = LoudnessCache(cache).measure(selected, method=method, processes=processes)
+	if not results:
+		print "No tracks could be measured"
+		return
+	if target is None:
+		target = median(results.values())
+
+	strategy = {
+		'update': MergeStrategies.update,
+		'average': MergeStrategies.average,
+		'untouched': lambda path, old, new: new if old == DEFAULT_VOLUME else old,
+	}[strategy]
+	# update each entry rather than merging, so only the measured volumes are recorded as changes
+	# and save() can re-apply them on top of any changes others make in the meantime
+	for path, loudness in results.iteritems():
+		weight, old = playlist.entries[path]
+		new = volume_for(loudness, target, reference)
+		if strategy(path, old, new) != old:
+			playlist.update(path, volume=lambda old, path=path, new=new: strategy(path, old, new))
+
+	if output:
+		playlist.writefile(output)
+	else:
+		playlist.save()
+	print "Measured {} of {} entries, target loudness {:.1f}".format(len(results), len(selected), target)
+
+
+if __name__ == '__main__':
+	argh.dispatch_command(main)
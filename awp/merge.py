@@ -4,16 +4,12 @@ Prints new list to stdout.
 """
 
 import sys
-from playlist import Playlist, MergeStrategies
+from playlist import Playlist, MergeStrategies, merge_all
 
 def merge(*playlists):
-	playlists = map(Playlist, playlists)
-	if not playlists: return
-	result = playlists.pop(0).copy()
 	strategy = MergeStrategies.extreme(16), MergeStrategies.extreme(0.5)
-	for playlist in playlists:
-		result.merge(playlist, strategy)
-	result.write(sys.stdout)
+	for path, weight, volume in merge_all(playlists, strategy):
+		sys.stdout.write(Playlist.format_line(path, weight, volume))
 
 if __name__ == '__main__':
 	merge(*sys.argv[1:])
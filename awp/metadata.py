@@ -0,0 +1,130 @@
+
+"""A persistent cache of track metadata, so that files don't need to be parsed every time they're played.
+
+As a script, fills a cache with the metadata for every entry in a playlist, parsing files
+with a pool of processes:
+	python -m awp.metadata CACHE PLAYLIST
+Also takes optional --options as follows:
+	--processes N: Number of processes to use. Defaults to number of CPUs.
+"""
+
+import logging
+import os
+import sqlite3
+from multiprocessing import Pool
+
+from scriptlib import with_argv
+
+from lastfm import getmetadata
+from playlist import Playlist
+
+
+FIELDS = ('title', 'artist', 'album', 'duration')
+
+
+def parse(filepath):
+	"""Read metadata from a file. Returns a dict of FIELDS, with values of None if not known."""
+	metadata = getmetadata(filepath)
+	if metadata is None:
+		metadata = {}
+	info = {field: metadata[field][0] if field in metadata else None for field in ('title', 'artist', 'album')}
+	info['duration'] = getattr(getattr(metadata, 'info', None), 'length', None)
+	return info
+
+
+class MetadataCache(object):
+	"""Stores track metadata (see FIELDS) in an SQLite database, along with the size and mtime of the file
+	it came from. Entries are re-parsed if the file has changed."""
+
+	def __init__(self, filepath):
+		self.db = sqlite3.connect(filepath)
+		self.db.execute("""
+			CREATE TABLE IF NOT EXISTS tracks (
+				path BLOB PRIMARY KEY,
+				size INTEGER,
+				mtime REAL,
+				{}
+			)
+		""".format(', '.join(FIELDS)))
+		self.db.commit()
+
+	def lookup(self, path, stat=None):
+		"""Returns the cached metadata for path, or None if it isn't cached or is stale.
+		stat may be given if already known."""
+		if stat is None:
+			stat = os.stat(path)
+		row = self.db.execute(
+			"SELECT size, mtime, {} FROM tracks WHERE path = ?".format(', '.join(FIELDS)),
+			(sqlite3.Binary(path),)
+		).fetchone()
+		if row is None or tuple(row[:2]) != (stat.st_size, stat.st_mtime):
+			return None
+		return dict(zip(FIELDS, row[2:]))
+
+	def store(self, path, stat, info, commit=True):
+		self.db.execute(
+			"INSERT OR REPLACE INTO tracks (path, size, mtime, {}) VALUES (?, ?, ?, {})".format(
+				', '.join(FIELDS), ', '.join('?' for field in FIELDS)),
+			(sqlite3.Binary(path), stat.st_size, stat.st_mtime) + tuple(info[field] for field in FIELDS)
+		)
+		if commit:
+			self.db.commit()
+
+	def get(self, path):
+		"""Returns metadata for path, from the cache if possible, otherwise parsing the file
+		and caching the result."""
+		stat = os.stat(path)
+		info = self.lookup(path, stat)
+		if info is None:
+			info = parse(path)
+			self.store(path, stat, info)
+		return info
+
+	def fill(self, paths, processes=None):
+		"""Ensure all paths are cached, parsing any that aren't with a pool of processes.
+		Returns the number of files parsed. Files which can't be read or parsed are logged and skipped."""
+		stale = []
+		for path in paths:
+			try:
+				if self.lookup(path) is None:
+					stale.append(path)
+			except OSError:
+				logging.warning("Could not stat {!r}".format(path), exc_info=True)
+
+		pool = Pool(processes)
+		count = 0
+		try:
+			for path, stat, info in pool.imap_unordered(_parse_for_fill, stale, chunksize=16):
+				if info is None:
+					continue
+				self.store(path, stat, info, commit=False)
+				count += 1
+				if count % 1000 == 0:
+					self.db.commit()
+		finally:
+			pool.terminate()
+			self.db.commit()
+		return count
+
+
+def _parse_for_fill(path):
+	"""Runs in a worker process. Returns (path, stat, info), or (path, None, None) on error."""
+	try:
+		# stat before parsing, so if the file changes while we parse it the entry will be stale
+		stat = os.stat(path)
+		return path, stat, parse(path)
+	except Exception:
+		logging.warning("Failed to parse {!r}".format(path), exc_info=True)
+		return path, None, None
+
+
+@with_argv
+def main(cache, playlist, processes=None):
+	playlist = Playlist(playlist)
+	cache = MetadataCache(cache)
+	count = cache.fill(playlist.entries, processes=int(processes) if processes else None)
+	print "Parsed {} of {} files".format(count, len(playlist.entries))
+
+
+if __name__ == '__main__':
+	main()
@@ -1,4 +1,3 @@
-
 """A script for listing files in a directory or subdirs that are NOT in given playlist.
 Usage:
 	python -m awp.missing PLAYLIST DIRECTORY
@@ -6,27 +5,79 @@ Also takes optional --options as follows:
 	--nomagic: Do not use libmagic to identify audio files
 	--extensions: Space-seperated list of file extensions to recognise
 	--norecurse: Do not search subdirs
-	--verbose
+	--index FILE: Keep a record of the directory tree in FILE, so later runs only need to
+	              re-list directories that have changed. The report is also kept there, and only
+	              recomputed for directories that have changed, unless the set of paths in the
+	              playlist has changed too.
+	--cache FILE: Cache libmagic results in FILE, so unchanged files are not checked again.
+	--workers N: Number of threads to use for libmagic checks.
+	--verbose: Also warn about playlist entries that weren't found. This checks every entry,
+	           so doesn't benefit from --index.
 """
 
+import os
+import zlib
+from itertools import imap
+
 from scriptlib import with_argv
 import awp.playlist
+from awp.scan import AUDIO_EXTENSIONS, DirectoryIndex
+
+
+def membership(playlist):
+	"""A fingerprint of the set of paths in a playlist, which ignores weights, volumes and order"""
+	return len(playlist.entries), sum(imap(zlib.crc32, playlist.entries))
+
+
+def report_from_index(playlist, index, extensions=AUDIO_EXTENSIONS):
+	"""Yields the audio files in an up-to-date DirectoryIndex which are not in playlist, in walk order.
+	The report for each directory is stored in the index along with the directory's mtime, and only
+	recomputed for directories whose mtime has changed, or for all of them if the playlist's paths have.
+	The caller should save the index afterwards.
+	"""
+	fingerprint = os.path.abspath(playlist.filepath), membership(playlist)
+	old_fingerprint, old_dirs = index.reports.get('missing', (None, {}))
+	if old_fingerprint != fingerprint:
+		old_dirs = {}
+	dirs = {} # {path: (mtime, missing files)}
+	for path, mtime, files in index.walk():
+		entry = old_dirs.get(path)
+		if entry is None or entry[0] != mtime:
+			found = awp.playlist.remove_duplicates([os.path.join(path, name) for name in files], extensions)
+			entry = mtime, [filepath for filepath in found if filepath not in playlist.entries]
+		dirs[path] = entry
+		for filepath in entry[1]:
+			yield filepath
+	index.reports['missing'] = fingerprint, dirs
+
 
 @with_argv
-def main(filename, searchpath, nomagic=False, extensions=None, norecurse=False, verbose=False):
+def main(filename, searchpath, nomagic=False, extensions=None, norecurse=False,
+         index=None, cache=None, workers=8, verbose=False):
 	if extensions: extensions = extensions.split()
 	playlist = awp.playlist.Playlist(filename)
 	kwargs = {'extensions': extensions} if extensions is not None else {}
-	found_list = awp.playlist.from_directory(searchpath, use_magic=(not nomagic), recurse=(not norecurse), **kwargs)
-	diff = playlist.diff(found_list)
+	options = dict(use_magic=(not nomagic), recurse=(not norecurse), cache=cache, workers=int(workers), **kwargs)
+
+	if index and not verbose:
+		index = DirectoryIndex(index)
+		index.scan(os.path.abspath(searchpath), **options)
+		for path in report_from_index(playlist, index, extensions or AUDIO_EXTENSIONS):
+			print path
+		index.save()
+		return
+
+	found_list = awp.playlist.from_directory(searchpath, index=index, **options)
 	if verbose:
 		print "{} contains {} entries".format(filename, len(playlist.entries))
 		print "{}/ contains {} entries".format(searchpath.rstrip('/'), len(found_list.entries))
-	for path, (us, them) in diff.items():
-		if us is None:
+	if verbose:
+		for path in playlist.entries:
+			if path not in found_list.entries:
+				print "WARNING: {} not in found list".format(path)
+	for path in found_list.entries:
+		if path not in playlist.entries:
 			print path
-		if verbose and them is None:
-			print "WARNING: {} not in found list".format(path)
 
 if __name__=='__main__':
 	main()
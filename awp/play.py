@@ -7,16 +7,17 @@ and controls.
 We still have to code commands that edit the playlist ourselves, mainly by intercepting
 keystrokes. As such it is less self-documenting (lacking a clear menu system).
 
-Some minor gripes: The latency between a song finishing and the next starting is higher,
-due to creating a new process every time.
+Some minor gripes: By default, the latency between a song finishing and the next starting is higher,
+due to creating a new process every time. The "slave" backend avoids this by keeping one mplayer
+running in slave mode, at the cost of only supporting a subset of mplayer's controls.
 
 In less concrete terms, this solution is "hacky" and possibly less reliable.
 """
 
-from gevent.subprocess import Popen, PIPE
 import gevent
 from gevent.select import select
 import os, sys
+import time
 import errno
 import logging
 import json
@@ -27,7 +28,11 @@ from escapes import CLEAR
 from termhelpers import TermAttrs
 
 from playlist import Playlist
-from lastfm import LastFM, getmetadata
+from players import BACKENDS
+from lastfm import LastFM, uni
+from instrument import Stats, monotonic
+from prefetch import Prefetcher
+from metadata import MetadataCache, parse as parse_metadata
 
 class RaiseOnExit(object):
 	"""Allows an exception to be raised upon a child exit.
@@ -44,8 +49,8 @@ class RaiseOnExit(object):
 	class ChildExited(Exception): pass
 
 	def __init__(self, proc, g_target=None, exception=ChildExited):
-		"""Pass in a greenlet g_target and a Popen object child.
-		When child exits, exception is raised in g_target.
+		"""Pass in a greenlet g_target and a Popen object (or anything with a wait() method) proc.
+		When proc exits, exception is raised in g_target.
 		exception defaults to RaiseOnExit.ChildExited.
 		g_target defaults to current greenlet at init time.
 		"""
@@ -64,22 +69,43 @@ class RaiseOnExit(object):
 		self.waiter.unlink(self.throw_func)
 
 
-def set_lastfm(lastfm, filename):
+def track_info(filename, cache=None):
+	"""Returns (title, artist, album, duration) of a track. album and duration may be None if unknown.
+	If cache (a MetadataCache) is given, metadata is looked up there instead of parsing the file."""
+	info = cache.get(filename) if cache else parse_metadata(filename)
+	title = info['title'] or os.path.splitext(os.path.basename(filename))[0]
+	artist = info['artist'] or 'unknown'
+	return title, artist, info['album'], info['duration']
+
+
+def set_lastfm(lastfm, filename, cache=None):
 	try:
-		metadata = getmetadata(filename)
-		title = (metadata['title'][0] if 'title' in metadata
-				 else os.path.splitext(os.path.basename(filename))[0])
-		artist = metadata['artist'][0] if 'artist' in metadata else 'unknown'
+		title, artist, album, duration = track_info(filename, cache)
 		lastfm.nowplaying(title, artist)
 	except Exception:
 		logging.warning("Failed to set lastfm now playing", exc_info=True)
 
 
+def scrobble_lastfm(lastfm, filename, started, ended, cache=None):
+	"""Scrobble a track if it played for long enough. As per last.fm's rules, the track must be
+	longer than 30 seconds, and have played for half its length or 4 minutes, whichever is sooner."""
+	try:
+		title, artist, album, duration = track_info(filename, cache)
+		if duration is not None and duration <= 30:
+			return
+		if ended - started < min(240, duration / 2. if duration else 240):
+			return
+		lastfm.scrobble(title, artist, started, album=album, duration=duration)
+	except Exception:
+		logging.warning("Failed to scrobble to lastfm", exc_info=True)
+
+
 def clamp(lower, value, upper):
 	return min(upper, max(lower, value))
 
 
-def play(playlist, ptype=Playlist, stdin=None, stdout=None, lastfm=None):
+def play(playlist, ptype=Playlist, stdin=None, stdout=None, lastfm=None, backend='process', journal=False,
+         metadata=None, stats=None, stats_interval=60, prefetch_budget=8 * 1024 * 1024):
 	"""Takes a Playlist and plays forever.
 	Controls (in addition to mplayer standard controls):
 		q: Skip and demote.
@@ -89,6 +115,19 @@ def play(playlist, ptype=Playlist, stdin=None, stdout=None, lastfm=None):
 	All promotions and demotions double/halve the weighting.
 	ptype is the Playlist subtype to use if paylist is string.
 	ptype may be string, in which case it should be "module:name" to import
+	backend chooses how mplayer is run, and may be a name from players.BACKENDS or a player class:
+		process: A new mplayer for each track, with all standard mplayer controls.
+		slave: One persistent mplayer in slave mode, for shorter gaps between tracks
+		       but only a subset of controls (see players.SlavePlayer).
+	If journal is True, changes are saved to the playlist's journal instead of rewriting it
+	every time (see Playlist).
+	metadata may be a MetadataCache or a filepath to one. If given, track metadata is read from it
+	(rather than parsing each file as it plays) and the title and artist are shown while playing.
+	stats may be an instrument.Stats or a filepath. Timings of each phase of the loop (and the gap between
+	one track ending and the next starting) are logged at DEBUG level, and if a filepath is given,
+	a JSON summary is written there every stats_interval seconds.
+	The first prefetch_budget bytes of each track are read in the background while the previous
+	one plays, so it starts promptly from slow disks. Set to 0 to disable.
 	"""
 
 	if not stdin:
@@ -106,91 +145,169 @@ def play(playlist, ptype=Playlist, stdin=None, stdout=None, lastfm=None):
 
 	if isinstance(playlist, str):
 		playlist = ptype(playlist)
-	else:
-		ptype = type(playlist)
+	if journal:
+		playlist.journal = True
+	if isinstance(metadata, basestring):
+		metadata = MetadataCache(metadata)
+	if not isinstance(stats, Stats):
+		stats = Stats(stats)
+	prefetcher = Prefetcher(prefetch_budget, stats)
 
 	VOL_MAX = int(os.environ.get('VOL_MAX',2)) # Sets what interface reports as "100%"
 	VOL_FUDGE = float(os.environ.get('VOL_FUDGE',1)) # Volume fudge factor to modify volume globally.
 	                                               # DISABLES PERSISTENT VOLUME CHANGES WHEN NOT DEFAULT
 
-	new_volume = [None] # one-element list to force non-local variable
+	if isinstance(backend, basestring):
+		backend = BACKENDS[backend]
+	player = backend(vol_max=VOL_MAX, vol_fudge=VOL_FUDGE)
+
+	def choose():
+		"""Returns the next (filename, volume) to play, or None if there's nothing to play"""
+		with stats.time('choose'):
+			try:
+				return playlist.next()
+			except ValueError as e:
+				logging.error("Nothing to play from {}: {}".format(playlist.filepath, e))
+				return None
+
+	def start(filename, volume):
+		weight, _ = playlist.entries[filename]
+		stdout.write(CLEAR + '\n{weight}x @{volume}\n{name}\n\n'.format(name=filename, volume=volume, weight=weight))
+		stats.count('tracks')
+		prefetcher.started(filename)
+		with stats.time('start'):
+			track = player.load(filename, volume)
+		# these may need to parse the file, so don't let them hold up the track starting
+		if lastfm:
+			gevent.spawn(set_lastfm, lastfm, filename, metadata)
+		if metadata:
+			gevent.spawn(show_metadata, filename)
+		return track
+
+	def show_metadata(filename):
+		try:
+			title, artist, album, duration = track_info(filename, metadata)
+		except Exception:
+			logging.warning("Failed to get metadata for {!r}".format(filename), exc_info=True)
+			return
+		stdout.write(u'{} - {}\n'.format(uni(artist), uni(title)).encode('utf-8'))
+		stdout.flush()
+
+	def write_stats():
+		while True:
+			gevent.sleep(stats_interval)
+			stats.write()
+	stats_writer = gevent.spawn(write_stats)
 
-	while True:
+	try:
+		current = choose()
+		if current is None:
+			return
+		filename, volume = current
+		track = start(filename, volume)
+		started = time.time()
 
-		filename, volume = playlist.next()
-		original_weight, _ = playlist.entries[filename]
+		while True:
 
-		if lastfm:
-			gevent.spawn(set_lastfm, lastfm, filename)
+			# choose what comes next now, so it can start as soon as this track finishes
+			upcoming = choose()
+			if upcoming is not None:
+				prefetcher.prefetch(upcoming[0])
 
-		proc = None
-		new_volume = volume
-		weight_change = 1
-		try:
-			stdout.write(CLEAR + '\n{weight}x @{volume}\n{name}\n\n'.format(name=filename, volume=volume, weight=original_weight))
-			proc = Popen(['mplayer', '-vo', 'none', '-softvol', '-softvol-max', str(VOL_MAX * 100.),
-						'-volume', str(VOL_FUDGE * volume * 100. / VOL_MAX), filename],
-						 stdin=PIPE, stderr=open('/dev/null','w'))
-
-			with RaiseOnExit(proc), \
-			     TermAttrs.modify(exclude=(0,0,0,ECHO|ECHONL|ICANON)):
-				while True:
-					c = read_stdin()
-					if c == 'q':
-						weight_change *= 0.5
-						proc.stdin.write("q")
-					elif c == 'f':
-						weight_change *= 2
-					elif c == 'd':
-						weight_change *= 0.5
-					elif c == 'Q':
-						proc.stdin.write("q")
-						proc.stdin.flush()
-						return
-					elif c in '*/':
-						change = 0.03 * VOL_MAX
-						if c == '/':
-							change = -change
-						new_volume = clamp(0, volume + change, 1)
-						# also write volume change so it takes effect immediately.
-						# note player can exceed 1 volume but we do not.
-						proc.stdin.write(c)
-						proc.stdin.flush()
-					else:
-						# we need to deliver entire escapes at once, or else
-						# mplayer does unexpected things (like quitting)
-						# so we read the entire available input before acting
-						while True:
-							r, w, x = select([stdin], [], [], 0)
-							if not r:
-								break
-							c += read_stdin()
-						proc.stdin.write(c)
-					proc.stdin.flush()
-
-		except OSError, e:
-			# There's a race that can occur here, causing a broken pipe error
-			if e.errno != errno.EPIPE: raise
-		except RaiseOnExit.ChildExited:
-			# This is the expected path out of the input loop
-			pass
-		finally:
-			if proc:
-				try:
-					proc.terminate()
-				except OSError, e:
-					if e.errno != errno.ESRCH: raise
-				proc.wait()
-
-		# Don't update volume on VOL_FUDGE
-		if VOL_FUDGE != 1:
 			new_volume = volume
-
-		# update playlist: read, update, write to minimize window where races may occur
-		playlist = ptype(playlist.filepath)
-		if weight_change != 1 or new_volume != volume:
-			playlist.update(filename, weight=lambda x: x * weight_change, volume=new_volume)
-			playlist.writefile()
+			weight_change = 1
+			try:
+				with RaiseOnExit(track), \
+				     TermAttrs.modify(exclude=(0,0,0,ECHO|ECHONL|ICANON)):
+					while True:
+						c = read_stdin()
+						if c == 'q':
+							weight_change *= 0.5
+							stats.count('skips')
+							player.skip()
+						elif c == 'f':
+							weight_change *= 2
+							stats.count('promotions')
+						elif c == 'd':
+							weight_change *= 0.5
+							stats.count('demotions')
+						elif c == 'Q':
+							return
+						elif c in '*/':
+							change = 0.03 * VOL_MAX
+							if c == '/':
+								change = -change
+							new_volume = clamp(0, volume + change, 1)
+							# also send volume change so it takes effect immediately.
+							# note player can exceed 1 volume but we do not.
+							player.send(c)
+						else:
+							# we need to deliver entire escapes at once, or else
+							# mplayer does unexpected things (like quitting)
+							# so we read the entire available input before acting
+							while True:
+								r, w, x = select([stdin], [], [], 0)
+								if not r:
+									break
+								c += read_stdin()
+							player.send(c)
+
+			except OSError, e:
+				# There's a race that can occur here, causing a broken pipe error
+				if e.errno != errno.EPIPE: raise
+			except RaiseOnExit.ChildExited:
+				# This is the expected path out of the input loop
+				pass
+
+			ended = time.time()
+			exited = monotonic()
+
+			# Don't update volume on VOL_FUDGE
+			if VOL_FUDGE != 1:
+				new_volume = volume
+
+			# update this track in memory now, as it's cheap, but only save after starting the next
+			changed = (weight_change != 1 or new_volume != volume) and filename in playlist.entries
+			if changed:
+				playlist.update(filename, weight=lambda x, change=weight_change: x * change, volume=new_volume)
+				if weight_change != 1:
+					# upcoming was chosen with this track's old weight, so eg. a track that was
+					# just skipped could be chosen to play again straight away. Choose again.
+					upcoming = choose()
+
+			if upcoming is None:
+				# nothing left to play, but keep any change to this track
+				if changed:
+					playlist.save()
+				return
+
+			# start the next track before doing anything slow
+			next_filename, next_volume = upcoming
+			next_track = start(next_filename, next_volume)
+			stats.record('gap', monotonic() - exited)
+
+			if lastfm:
+				gevent.spawn(scrobble_lastfm, lastfm, filename, started, ended, metadata)
+			started = ended
+
+			# pick up any changes made by others so the next choice reflects them,
+			# then write ours. reload() and save() re-apply our update on top of anything changed by others.
+			with stats.time('reload'):
+				if playlist.changed_on_disk():
+					playlist.reload()
+					stats.count('reloads')
+			if changed:
+				with stats.time('save'):
+					playlist.save()
+
+			filename, volume, track = next_filename, next_volume, next_track
+
+	finally:
+		stats_writer.kill()
+		stats.write()
+		player.close()
+		if lastfm and not lastfm.flush(timeout=5):
+			logging.warning("Exiting with lastfm submissions still queued")
 
 
 def log_config(level, filepath, filelevel='DEBUG'):
@@ -207,7 +324,8 @@ def log_config(level, filepath, filelevel='DEBUG'):
 	logger.addHandler(file)
 
 
-def main(playlist, ptype='', lastfm_creds=None, loglevel='WARNING', logfile='/tmp/awp', logfilelevel='DEBUG'):
+def main(playlist, ptype='', lastfm_creds=None, backend='process', journal=False, metadata_cache=None,
+         stats_file=None, stats_interval=60, prefetch_budget=8 * 1024 * 1024, loglevel='WARNING', logfile='/tmp/awp', logfilelevel='DEBUG'):
 	log_config(loglevel, logfile, logfilelevel)
 	kwargs = {}
 	if ptype:
@@ -218,7 +336,9 @@ def main(playlist, ptype='', lastfm_creds=None, loglevel='WARNING', logfile='/tm
 		creds = json.loads(open(lastfm_creds).read())
 		lastfm = LastFM(**creds)
 		kwargs['lastfm'] = lastfm
-	play(playlist, **kwargs)
+	play(playlist, backend=backend, journal=journal, metadata=metadata_cache,
+	     stats=stats_file, stats_interval=float(stats_interval),
+	     prefetch_budget=int(prefetch_budget), **kwargs)
 
 
 if __name__ == '__main__':
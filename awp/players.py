@@ -0,0 +1,163 @@
+
+"""Backends for controlling mplayer.
+
+All players share the same interface:
+	load(filename, volume): Start playing filename at the given volume, replacing anything already playing.
+	                        Returns an object with a wait() method, which returns once that track has finished.
+	                        Note that Popen objects fit this description.
+	send(keys): Pass through keystrokes from the user.
+	skip(): Finish the current track early.
+	close(): Stop playing and clean up.
+"""
+
+import errno
+import logging
+from collections import deque
+
+from gevent.event import Event
+from gevent.subprocess import Popen, PIPE, STDOUT
+import gevent
+
+
+class ProcessPlayer(object):
+	"""Plays each track in a new mplayer process, which is passed keystrokes directly.
+	This exposes all of mplayer's standard controls, at the cost of a higher latency
+	between tracks due to creating a new process every time.
+	"""
+
+	def __init__(self, vol_max=2, vol_fudge=1, command='mplayer'):
+		self.vol_max = vol_max
+		self.vol_fudge = vol_fudge
+		self.command = command
+		self.proc = None
+
+	def load(self, filename, volume):
+		self.close()
+		self.proc = Popen([self.command, '-vo', 'none', '-softvol', '-softvol-max', str(self.vol_max * 100.),
+		                   '-volume', str(self.vol_fudge * volume * 100. / self.vol_max), filename],
+		                  stdin=PIPE, stderr=open('/dev/null','w'))
+		return self.proc
+
+	def send(self, keys):
+		self.proc.stdin.write(keys)
+		self.proc.stdin.flush()
+
+	def skip(self):
+		self.send('q')
+
+	def close(self):
+		if not self.proc:
+			return
+		try:
+			self.proc.terminate()
+		except OSError, e:
+			if e.errno != errno.ESRCH: raise
+		self.proc.wait()
+		self.proc = None
+
+
+class SlaveTrack(object):
+	def __init__(self, filename):
+		self.filename = filename
+		self.finished = Event()
+
+	def wait(self):
+		self.finished.wait()
+
+
+class SlavePlayer(object):
+	"""Keeps one long-lived mplayer process in slave mode, and switches tracks with slave commands.
+	This avoids a new process per track, making the gap between tracks much smaller.
+	mplayer doesn't read keystrokes in slave mode, so the most common controls are translated
+	into slave commands (see KEYS). Other keys are ignored.
+	"""
+
+	KEYS = {
+		' ': 'pause',
+		'p': 'pause',
+		'm': 'mute',
+		'*': 'volume 1',
+		'0': 'volume 1',
+		'/': 'volume -1',
+		'9': 'volume -1',
+		'\x1b[C': 'seek 10', # right
+		'\x1b[D': 'seek -10', # left
+		'\x1b[A': 'seek 60', # up
+		'\x1b[B': 'seek -60', # down
+		'\x1b[5~': 'seek 600', # page up
+		'\x1b[6~': 'seek -600', # page down
+	}
+
+	def __init__(self, vol_max=2, vol_fudge=1, command='mplayer'):
+		self.vol_max = vol_max
+		self.vol_fudge = vol_fudge
+		self.command = command
+		self.proc = None
+		self.tracks = deque() # tracks that have been loaded but not yet finished, oldest first
+
+	# Printed by mplayer (on stderr) when it can't play a file at all. It then goes back to idle
+	# without printing "EOF code:", so these also mean the track has finished.
+	LOAD_FAILURES = (
+		'Failed to recognize file format.',
+	)
+
+	def start(self):
+		# -msglevel global=6 makes mplayer report "EOF code: N" whenever it stops playing a file
+		# it managed to open, for whatever reason, which is how we know when a track has finished.
+		self.proc = Popen([self.command, '-slave', '-idle', '-quiet', '-msglevel', 'global=6',
+		                   '-vo', 'none', '-softvol', '-softvol-max', str(self.vol_max * 100.)],
+		                  stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+		gevent.spawn(self._read_output, self.proc)
+
+	def _read_output(self, proc):
+		for line in iter(proc.stdout.readline, ''):
+			if not self.tracks:
+				continue
+			line = line.rstrip('\r\n')
+			if line.startswith('EOF code:'):
+				self.tracks.popleft().finished.set()
+			elif line in self.LOAD_FAILURES or line == 'Failed to open {}.'.format(self.tracks[0].filename):
+				logging.warning("mplayer failed to play {!r}: {}".format(self.tracks[0].filename, line))
+				self.tracks.popleft().finished.set()
+		# mplayer has exited, so nothing it was playing will ever finish by itself
+		logging.info("mplayer slave process exited with {}".format(proc.wait()))
+		while self.tracks:
+			self.tracks.popleft().finished.set()
+
+	def slave_command(self, *args):
+		self.proc.stdin.write('{}\n'.format(' '.join(map(str, args))))
+		self.proc.stdin.flush()
+
+	def load(self, filename, volume):
+		if not self.proc or self.proc.poll() is not None:
+			self.start()
+		track = SlaveTrack(filename)
+		self.tracks.append(track)
+		self.slave_command('loadfile', '"{}"'.format(filename.replace('\\', '\\\\').replace('"', '\\"')))
+		self.slave_command('volume', self.vol_fudge * volume * 100. / self.vol_max, 1)
+		return track
+
+	def send(self, keys):
+		if keys in self.KEYS:
+			self.slave_command(self.KEYS[keys])
+
+	def skip(self):
+		self.slave_command('stop')
+
+	def close(self):
+		if not self.proc:
+			return
+		try:
+			self.slave_command('quit')
+		except (OSError, IOError), e:
+			if e.errno != errno.EPIPE: raise
+		if gevent.with_timeout(1, self.proc.wait, timeout_value=None) is None:
+			self.proc.kill()
+			self.proc.wait()
+		self.proc = None
+
+
+BACKENDS = {
+	'process': ProcessPlayer,
+	'slave': SlavePlayer,
+}
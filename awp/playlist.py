@@ -1,6 +1,26 @@
-from rand import weighted_choice
+from entries import Entries
+from scan import AUDIO_EXTENSIONS, DirectoryIndex, find_audio, verify_paths
+from array import array
 from collections import OrderedDict
+from contextlib import contextmanager
+from fractions import Fraction, gcd
+from itertools import izip, repeat
+import errno
+import heapq
+import math
 import os
+import random
+import struct
+import sys
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None # no locking on this platform
+
+BINARY_MAGIC = 'AWPB'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sB3xQ') # magic, version, padding, number of entries
 
 class Playlist(object):
 	"""Playlist files are newline-seperated records of one song per line.
@@ -19,83 +39,520 @@ class Playlist(object):
 	It is for this reason the default volume is half of normal.
 
 	PATH may be any string without newlines, but should be an absolute filepath to an audio file.
+
+	Playlists may also be stored in a binary format, which is much faster to load. It consists of:
+		A header: The 4 bytes "AWPB", a 1-byte version number, 3 bytes padding, and an 8-byte entry count N.
+		N weights, as little-endian 8-byte floats.
+		N volumes, in the same form.
+		N paths, each followed by a newline.
+	Both formats are read transparently, and writefile() uses the format most recently read
+	unless told otherwise.
+
+	A playlist file may be accompanied by a journal, a hidden file ".NAME.journal" in the same directory.
+	It contains lines of the same form as the playlist, except that a WEIGHT and VOLUME of "-" indicates
+	the entry was removed. When the playlist is read, each line in the journal replaces the entry
+	for that path. This allows small changes to be saved without rewriting the whole file.
+
+	Several processes may share a playlist file. Writers take an advisory lock on a hidden file
+	".NAME.lock" alongside it, and before writing, check whether the file has changed since we last
+	read or wrote it. If it has, it is re-read and our own changes re-applied on top (see reload()),
+	so changes made by others are not lost.
 	"""
 
 	filepath = None
+	format = 'text' # 'text' or 'binary', see writefile()
 	dirty = False # flag indicating pending changes not copied to disk. False for new, empty playlist.
-
-	def __init__(self, filepath=None):
-		"""Open a playlist file. Omit filepath to create an empty playlist."""
-		self.entries = OrderedDict() # { path : (weight, volume) } - ordered so reading a file preserves order
+	journal = False # if True, save() appends changes to the journal instead of rewriting the file
+	JOURNAL_LIMIT = 1024 * 1024 # size in bytes after which save() folds the journal back into the file
+	_stat = None # identifies the version of filepath we last read or wrote, see changed_on_disk()
+	_lock_depth = 0 # how many nested lock() contexts we are in
+
+	def __init__(self, filepath=None, journal=False):
+		"""Open a playlist file. Omit filepath to create an empty playlist.
+		If journal is True, save() will write changes to a journal. See the class docstring."""
+		self.entries = Entries() # { path : (weight, volume) } - ordered so reading a file preserves order
+		self._pending = [] # changes made since filepath was last read or written, see reload()
+		self.journal = journal
 		if filepath:
 			self.readfile(filepath)
 
 	def readfile(self, filepath):
 		"""Append file to playlist."""
 		self.filepath = filepath
-		with open(filepath, 'r') as f:
-			for line in f:
-				line = line[:-1] # Strip newline
-				if not line: continue # Blank lines
-				if line.lstrip().startswith('#'): continue # Comments
-				parts = line.split('\t', 2)
-				if len(parts) == 2:
-					weight, path = parts
-					volume = 1
-				elif len(parts) == 3:
-					weight, volume, path = parts
-				else:
-					raise ValueError("Bad line: %s" % line)
+		with self.lock(filepath, shared=True):
+			self._read_locked(filepath)
+
+	def _read_locked(self, filepath):
+		pending, self._pending = self._pending, [] # loaded entries aren't changes
+		with open(filepath, 'rb') as f:
+			if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+				self.format = 'binary'
+				self._read_binary(f)
+			else:
+				self.format = 'text'
+				f.seek(0)
+				self._read_text(f)
+			file_stat = self._stat_key(os.fstat(f.fileno()))
+		journal_stat = self._read_journal(filepath)
+		self._stat = file_stat, journal_stat
+		self._pending = pending
+
+	def _read_text(self, f):
+		lines = f.read().split('\n')
+		if not lines[-1]:
+			lines.pop() # Trailing newline
+		# Fast path: if every line is WEIGHT\tVOLUME\tPATH, we can split all lines at once and
+		# convert whole columns. Anything else (comments, blank lines, two-column lines, paths
+		# containing tabs, bad values, duplicates) falls back to parsing line by line.
+		try:
+			if map(str.count, lines, repeat('\t', len(lines))).count(2) != len(lines):
+				raise ValueError("Not all lines have three columns")
+			fields = '\t'.join(lines).split('\t')
+			weights, volumes, paths = fields[0::3], fields[1::3], fields[2::3]
+			weights = array('d', map(float, weights))
+			volumes = array('d', map(float, volumes))
+			if self.entries:
+				raise ValueError("Can't bulk load into non-empty playlist")
+			self.entries.extend(paths, weights, volumes)
+		except ValueError:
+			self._read_text_lines(lines)
+		else:
+			self.dirty = True
+
+	def _read_text_lines(self, lines):
+		for lineno, line in enumerate(lines, 1):
+			if not line: continue # Blank lines
+			if line.lstrip().startswith('#'): continue # Comments
+			parts = line.split('\t', 2)
+			if len(parts) == 2:
+				weight, path = parts
+				volume = 1
+			elif len(parts) == 3:
+				weight, volume, path = parts
+			else:
+				raise ValueError("Bad line {}: {}".format(lineno, line))
+			try:
 				weight = float(weight)
 				volume = float(volume)
+			except ValueError as e:
+				raise ValueError("Bad line {}: {}: {}".format(lineno, e, line))
+			self.add_item(path, weight, volume)
+
+	def _read_binary(self, f):
+		# the columns are read straight into arrays and the paths with one read, without intermediate copies
+		f.seek(0)
+		header = f.read(BINARY_HEADER.size)
+		if len(header) != BINARY_HEADER.size:
+			raise ValueError("Corrupt binary playlist: truncated header")
+		magic, version, count = BINARY_HEADER.unpack(header)
+		if version != BINARY_VERSION:
+			raise ValueError("Unknown binary playlist version: {}".format(version))
+		columns = []
+		for column in range(2):
+			values = array('d')
+			try:
+				values.fromfile(f, count)
+			except EOFError:
+				raise ValueError("Corrupt binary playlist: expected {} values per column".format(count))
+			if sys.byteorder != 'little':
+				values.byteswap()
+			columns.append(values)
+		paths = f.read().split('\n')
+		if paths.pop() or len(paths) != count:
+			raise ValueError("Corrupt binary playlist: expected {} paths".format(count))
+		weights, volumes = columns
+		if self.entries:
+			for path, weight, volume in izip(paths, weights, volumes):
 				self.add_item(path, weight, volume)
+		else:
+			# fast path - no need to check for duplicates
+			self.entries.extend(paths, weights, volumes)
+			self.dirty = True
+
+	@staticmethod
+	def journal_path(filepath):
+		dirname, basename = os.path.split(filepath)
+		return os.path.join(dirname, ".{}.journal".format(basename))
 
-	def writefile(self, filepath=None, atomic=True):
+	@staticmethod
+	def lock_path(filepath):
+		dirname, basename = os.path.split(filepath)
+		return os.path.join(dirname, ".{}.lock".format(basename))
+
+	@contextmanager
+	def lock(self, filepath=None, shared=False):
+		"""Hold an advisory lock on filepath (default our file) for the duration of the context.
+		Writers hold an exclusive lock while checking for changes and writing, readers a shared one
+		so they never see a file and journal from different writes.
+		Nested uses do nothing, as the outer one already holds the lock.
+		If locking isn't supported or the lock file can't be created, no lock is taken.
+		"""
+		if not filepath: filepath = self.filepath
+		if not filepath: raise ValueError("Cannot determine filepath")
+		lockfile = None
+		if fcntl and not self._lock_depth:
+			try:
+				lockfile = open(self.lock_path(filepath), 'a')
+			except IOError as e:
+				if e.errno not in (errno.EACCES, errno.EROFS): raise
+			else:
+				fcntl.flock(lockfile, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+		self._lock_depth += 1
+		try:
+			yield
+		finally:
+			self._lock_depth -= 1
+			if lockfile:
+				lockfile.close() # releases the lock
+
+	def _read_journal(self, filepath):
+		"""Apply the journal for filepath, if any. Returns the stat key of the journal, or None."""
+		try:
+			f = open(self.journal_path(filepath), 'r')
+		except IOError as e:
+			if e.errno != errno.ENOENT: raise
+			return None
+		with f:
+			for line in f:
+				if not line.endswith('\n'): continue # partially written record, eg. due to a crash
+				weight, volume, path = line[:-1].split('\t', 2)
+				if weight == '-':
+					self.remove_item(path)
+				else:
+					self.add_item(path, float(weight), float(volume), warn=False)
+			return self._stat_key(os.fstat(f.fileno()))
+
+	def reload(self):
+		"""Discard our entries and re-read them from our file, then re-apply any changes made
+		since it was last read or written. This picks up changes made to the file by others
+		without losing our own. Changes to entries that no longer exist are dropped.
+		"""
+		pending = self._pending
+		self.entries = Entries()
+		self._pending = []
+		self.readfile(self.filepath)
+		for op in pending:
+			kind, path, args = op[0], op[1], op[2:]
+			if kind == 'add':
+				self.add_item(path, *args, warn=False)
+			elif kind == 'remove':
+				self.remove_item(path)
+			elif kind == 'transform':
+				weight, volume, vectorized = args
+				self.transform(weight, volume, paths=path, vectorized=vectorized)
+			elif kind == 'rewrite_prefix':
+				try:
+					self.rewrite_prefix(path, *args)
+				except ValueError as e:
+					print "Warning: Dropping change: {}".format(e)
+			elif path in self.entries:
+				self.update(path, *args)
+		self.dirty = bool(self._pending)
+
+	def changed_on_disk(self):
+		"""Returns True if our file or its journal has been replaced or modified since we last read or wrote it."""
+		try:
+			return self._disk_state() != self._stat
+		except OSError:
+			return True
+
+	def _disk_state(self):
+		"""Returns stat keys for our file and its journal (or None if there isn't one)"""
+		try:
+			journal_stat = self._stat_key(os.stat(self.journal_path(self.filepath)))
+		except OSError as e:
+			if e.errno != errno.ENOENT: raise
+			journal_stat = None
+		return self._stat_key(os.stat(self.filepath)), journal_stat
+
+	@staticmethod
+	def _stat_key(stat):
+		return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+
+	def save(self):
+		"""Write any changes to our file. If self.journal is set, only the changed entries
+		are appended to the journal, which is folded back into the file (see compact())
+		once it grows larger than JOURNAL_LIMIT. Otherwise, the whole file is rewritten.
+		Either way, if the file has been changed by someone else, their changes are kept (see writefile()).
+		Changes which can't be journalled entry by entry (see rewrite_prefix()) also rewrite the whole file.
+		"""
+		if not self.journal or any(op[0] == 'rewrite_prefix' for op in self._pending):
+			self.writefile()
+			return
+		if not self._pending:
+			return
+		with self.lock():
+			if self.changed_on_disk():
+				self.reload()
+			self._append_journal()
+
+	def _append_journal(self):
+		changed = OrderedDict()
+		for op in self._pending:
+			for path in (op[1] if op[0] == 'transform' else [op[1]]):
+				changed[path] = None
+		records = []
+		for path in changed:
+			if path in self.entries:
+				records.append(self.format_line(path, *self.entries[path]))
+			else:
+				records.append('-\t-\t{}\n'.format(path))
+		with open(self.journal_path(self.filepath), 'a') as f:
+			f.write(''.join(records))
+			f.flush()
+			os.fsync(f.fileno())
+			journal_stat = self._stat_key(os.fstat(f.fileno()))
+		file_stat, _ = self._stat
+		self._stat = file_stat, journal_stat
+		self._pending = []
+		self.dirty = False
+		if journal_stat[2] > self.JOURNAL_LIMIT:
+			self.compact()
+
+	def compact(self):
+		"""Fold our journal back into our file, by rewriting the file with all entries and removing the journal."""
+		self.writefile()
+
+	def writefile(self, filepath=None, atomic=True, format=None):
 		"""Write playlist to file. If atomic, writes to a temp file then does an atomic move operation.
 		If no filepath given, defaults to the one most recently read from, or else ValueError.
+		format may be 'text' or 'binary', and defaults to the format most recently read (see class docstring).
+		When writing to the file we were read from, if it has been changed since we last read or wrote it,
+		it is first reloaded (see reload()) so that we only overwrite it with our own changes.
 		"""
+		if not format: format = self.format
+		if format not in ('text', 'binary'): raise ValueError("Unknown format: {!r}".format(format))
 		if not filepath: filepath = self.filepath
 		if not filepath: raise ValueError("Cannot determine filepath")
+		with self.lock(filepath):
+			if filepath == self.filepath and self.changed_on_disk():
+				self.reload()
+			self._write_locked(filepath, atomic, format)
+
+	def _write_locked(self, filepath, atomic, format):
 		if atomic:
 			true_path = filepath
 			dirname, basename = os.path.split(filepath)
 			filepath = os.path.join(dirname, ".{}~".format(basename))
-		with open(filepath, 'w') as f:
-			self.write(f)
+		with open(filepath, 'wb') as f:
+			if format == 'binary':
+				self.write_binary(f)
+			else:
+				self.write(f)
 		if atomic:
 			os.rename(filepath, true_path)
+			filepath = true_path
+		if filepath == self.filepath:
+			# the file now contains everything that was in the journal
+			try:
+				os.remove(self.journal_path(filepath))
+			except OSError as e:
+				if e.errno != errno.ENOENT: raise
+			self._stat = self._stat_key(os.stat(filepath)), None
+			self._pending = []
 		self.dirty = False
 
 	def write(self, f):
 		for path, (weight, volume) in self.entries.items():
-			f.write('{}\t{}\t{}\n'.format(weight, volume, path))
+			f.write(self.format_line(path, weight, volume))
+
+	@staticmethod
+	def format_line(path, weight, volume):
+		"""Return an entry in the form of a line of a playlist file"""
+		return '{}\t{}\t{}\n'.format(weight, volume, path)
+
+	def write_binary(self, f):
+		f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(self.entries)))
+		for column in range(2):
+			values = array('d', (entry[column] for entry in self.entries.itervalues()))
+			if sys.byteorder != 'little':
+				values.byteswap()
+			values.tofile(f)
+		f.write(''.join('{}\n'.format(path) for path in self.entries))
 
 	def add_item(self, path, weight, volume, warn=True):
 		"""If warn=True, prints a warning to stdout on duplicate entry."""
-		self.dirty = True
 		if warn and path in self.entries:
 			print "Warning: Overwriting existing entry %s" % self.format_entry(path)
+		self._set_item(path, weight, volume)
+		self._record('add', path, weight, volume)
+
+	def _set_item(self, path, weight, volume):
+		self.dirty = True
 		self.entries[path] = (weight, volume)
 
+	def remove_item(self, path):
+		"""Remove an entry if present. Returns the removed (weight, volume), or None."""
+		if path not in self.entries:
+			return None
+		self.dirty = True
+		self._record('remove', path)
+		return self.entries.pop(path)
+
+	def list_under(self, directory):
+		"""Returns a list of all paths under the given directory, in order"""
+		return list(self.entries.iter_under(directory))
+
+	def drop_subtree(self, directory):
+		"""Remove all entries under the given directory. Returns the number removed."""
+		paths = self.list_under(directory)
+		for path in paths:
+			self.remove_item(path)
+		return len(paths)
+
+	def rewrite_prefix(self, src, dest):
+		"""Move every entry under directory src to be under directory dest instead, keeping order.
+		Raises ValueError if this would make two entries have the same path.
+		It is recorded as a single change, so the next save() rewrites the whole file
+		rather than journalling every moved entry.
+		"""
+		if self.entries.rewrite_prefix(src, dest):
+			self.dirty = True
+			self._record('rewrite_prefix', src, dest)
+
+	def _record(self, *op):
+		"""Remember a change so it can be re-applied by reload()"""
+		if self.filepath:
+			self._pending.append(op)
+
 	def update(self, path, weight=None, volume=None):
 		"""Update a path's weight or volume or both.
 		Either field accepts a new value, None to keep old value, or a callable that maps old -> new value.
 		eg. update('example.mp3', lambda x: x*2) would double the weight of 'example.mp3'.
 		"""
 		old_weight, old_volume = self.entries[path]
+		self._record('update', path, weight, volume)
 		if weight is None: weight = lambda x: x
 		if callable(weight): weight = weight(old_weight)
 		if volume is None: volume = lambda x: x
 		if callable(volume): volume = volume(old_volume)
-		self.add_item(path, weight, volume, warn=False)
+		self._set_item(path, weight, volume)
+
+	def select(self, paths=None, under=None, predicate=None):
+		"""Returns a list of paths of entries that match all the given conditions, in order:
+			paths: An iterable of paths. Paths not in the playlist are ignored.
+			under: A directory, matching all entries under it.
+			predicate: A function that takes a path and returns True if it matches.
+		If no conditions are given, all entries match.
+		"""
+		return [self.entries.path_at(i) for i in self._select(paths, under, predicate)]
+
+	def _select(self, paths=None, under=None, predicate=None):
+		"""As per select(), but returns positions in self.entries' columns"""
+		if paths is not None:
+			positions = (self.entries.position(path) for path in paths)
+			positions = sorted(set(i for i in positions if i is not None))
+			if under is not None:
+				under = set(self.entries.positions_under(under))
+				positions = [i for i in positions if i in under]
+		elif under is not None:
+			positions = self.entries.positions_under(under)
+		else:
+			positions = [i for i, path in enumerate(self.entries.paths) if path is not None]
+		if predicate is not None:
+			positions = [i for i in positions if predicate(self.entries.path_at(i))]
+		return positions
+
+	def transform(self, weight=None, volume=None, paths=None, under=None, predicate=None, vectorized=False):
+		"""Update many entries at once. Entries are chosen as per select(), and weight and volume
+		are as per update(), ie. a new value, None to keep the old value, or a callable mapping old -> new.
+		eg. transform(lambda x: x / 2, under='/music/foo') halves the weight of everything under /music/foo.
+		If vectorized is True, callables are called only once, with a numpy array of all the old values,
+		and should return an array (or single value) of new values.
+		eg. transform(lambda x: x * 16 * len(x) / x.sum(), vectorized=True) rescales weights to average 16.
+		Changes are applied to whole columns at once rather than entry by entry.
+		Returns the number of entries selected.
+		"""
+		positions = self._select(paths, under, predicate)
+		if not positions:
+			return 0
+		if vectorized:
+			import numpy
+			indexes = numpy.array(positions, dtype=numpy.intp)
+		columns = {}
+		for name, func in (('weights', weight), ('volumes', volume)):
+			if func is None:
+				continue
+			if vectorized:
+				column = numpy.frombuffer(getattr(self.entries, name), dtype=float).copy()
+				column[indexes] = func(column[indexes]) if callable(func) else func
+				columns[name] = array('d')
+				columns[name].fromstring(column.tostring())
+			else:
+				column = columns[name] = array('d', getattr(self.entries, name))
+				for i in positions:
+					column[i] = func(column[i]) if callable(func) else func
+		self.entries.set_columns(**columns)
+		self.dirty = True
+		if self.filepath:
+			self._record('transform', [self.entries.path_at(i) for i in positions], weight, volume, vectorized)
+		return len(positions)
 
 	def __iter__(self):
 		return self
 
 	def next(self):
-		"""Get next thing to play. Returns (path, volume)"""
-		weights = { (path, volume) : weight for path, (weight, volume) in self.entries.items() }
-		return weighted_choice(weights)
+		"""Get next thing to play. Returns (path, volume).
+		Raises ValueError if there is nothing to choose, ie. no entries with a positive weight."""
+		if not self.entries.total() > 0:
+			raise ValueError("No entries with a positive weight to choose from")
+		i = self.entries.choice_position()
+		return self.entries.path_at(i), self.entries.volumes[i]
+
+	def sample(self, n, unique=False, seed=None):
+		"""Choose n things to play at once. Returns a list of (path, volume).
+		If unique, no path will be chosen more than once, in which case fewer than n results
+		will be returned if there aren't enough entries with a non-zero weight.
+		seed may be given to make the result repeatable.
+		Uses numpy to do the whole batch at once if available.
+		"""
+		try:
+			import numpy
+		except ImportError:
+			numpy = None
+
+		if numpy is not None:
+			indexes = self._sample_numpy(numpy, n, unique, seed)
+			chosen = (self.entries.path_at(i) for i in indexes)
+		else:
+			chosen = self._sample_python(n, unique, seed)
+		return [(path, self.entries[path][1]) for path in chosen]
+
+	def _sample_numpy(self, numpy, n, unique, seed):
+		"""Returns a list of positions in self.entries' columns"""
+		if not self.entries:
+			return []
+		rng = numpy.random.RandomState(seed)
+		weights = numpy.frombuffer(self.entries.weights, dtype=float) # gaps have 0 weight, so are never chosen
+		if unique:
+			# Efraimidis-Spirakis: key each entry by log(u)/weight, where u is uniform in (0, 1],
+			# and take the n largest keys. We only need a partial sort to find them.
+			candidates = numpy.flatnonzero(weights > 0)
+			n = min(n, len(candidates))
+			if not n:
+				return []
+			keys = numpy.log(1 - rng.random_sample(len(candidates))) / weights[candidates]
+			top = numpy.argpartition(-keys, n - 1)[:n]
+			top = top[numpy.argsort(-keys[top])]
+			return candidates[top].tolist()
+		cumulative = numpy.cumsum(weights)
+		if not len(cumulative) or not cumulative[-1] > 0:
+			return []
+		indexes = numpy.searchsorted(cumulative, rng.random_sample(n) * cumulative[-1], side='right')
+		# guard against float rounding putting us past the last entry
+		return numpy.minimum(indexes, numpy.flatnonzero(weights > 0)[-1]).tolist()
+
+	def _sample_python(self, n, unique, seed):
+		"""Returns a list of paths"""
+		rng = random if seed is None else random.Random(seed)
+		if unique:
+			# see _sample_numpy
+			keyed = ((math.log(1 - rng.random()) / weight, path)
+			         for path, (weight, volume) in self.entries.iteritems() if weight > 0)
+			return [path for key, path in heapq.nlargest(n, keyed)]
+		if not self.entries.total() > 0:
+			return []
+		return [self.entries.choice(rng.random) for _ in xrange(n)]
 
 	def copy(self):
 		result = Playlist()
@@ -112,9 +569,11 @@ class Playlist(object):
 	def __str__(self):
 		return "<Playlist{} ({} entries)>".format(" {!r}".format(self.filepath) if self.filepath else '', len(self.entries))
 
-	def verify(self):
-		"""Return a list of all entries whose files cannot be accessed."""
-		return [path for path in self.entries if not os.access(path, os.R_OK)]
+	def verify(self, workers=8, cache=None):
+		"""Return a list of all entries whose files cannot be accessed.
+		See scan.verify_paths for details and arguments, including a way to get results as they are found."""
+		bad = set(verify_paths(self.entries, workers=workers, cache=cache))
+		return [path for path in self.entries if path in bad]
 
 	def diff(self, other):
 		"""Compares this playlist with another and returns a structure describing the differences.
@@ -124,9 +583,7 @@ class Playlist(object):
 		Order is as per this playlist, with paths not in this playlist inserted in order
 		at the end.
 		"""
-		paths = self.entries.copy()
-		paths.update(other.entries)
-		paths = paths.keys()
+		paths = self.entries.keys() + [path for path in other.entries if path not in self.entries]
 		ret = OrderedDict()
 		for path in paths:
 			ours, theirs = (playlist.entries.get(path, None) for playlist in (self, other))
@@ -173,62 +630,136 @@ class Playlist(object):
 			merged = tuple(strategy(path, wgt, vol) for strategy, wgt, vol in zip(strategies, ours, theirs))
 			assert len(merged) == 2, "Something went wrong with the zip"
 			if None in merged:
-				self.entries.pop(path, None) # remove if present
+				self.remove_item(path)
 			else:
 				self.add_item(path, *merged, warn=False)
 
-	def _common_divisor_weight(self):
-		"""Attempt to guess the greatest common divisor of our weights.
-		Will give up and ValueError in some cases. May not give the greatest common divisor,
-		but will always give *some* common divisor.
+	def merge_many(self, others, strategy=None):
+		"""Update this playlist by merging in any number of other playlists at once.
+		This is equivalent to repeated calls to merge(), except that strategy functions are applied
+		to the values from all the playlists together (see merge_all), and each playlist is only read once.
+		others may be filenames or Playlists.
+		"""
+		merged = OrderedDict((path, (weight, volume)) for path, weight, volume
+		                     in merge_all([self] + list(others), strategy))
+		for path in self.entries.keys():
+			if path not in merged:
+				self.remove_item(path)
+		for path, value in merged.iteritems():
+			if self.entries.get(path) != value:
+				self.add_item(path, *value, warn=False)
+
+	REPEAT_LIMIT = 2**20 # most copies of one entry allowed when automatically choosing a scale
+
+	def _common_divisor_weight(self, tolerance=None):
+		"""Find the greatest common divisor of our weights, as a Fraction.
+		Weights are converted to fractions exactly, eg. weights of 0.5 and 0.75 have a divisor of 0.25.
+		Since many decimals (eg. 0.1) are not exact in binary, this may give a very small divisor.
+		To avoid this, tolerance may be given, in which case each weight is first approximated by the
+		closest fraction with a small enough denominator to be within that relative tolerance.
+		Raises ValueError if there are no non-zero weights.
 		Note: Ignores entries with 0 weight"""
-		BRUTE_LIMIT = 1000
-
-		weights = set(weight for weight, vol in self.entries.values()) - {0}
-		def is_divisor(n):
-			return all(x % n == 0 for x in weights)
-		# we take a VERY naive and VERY inefficient route to guessing a GCD of the set of weights:
-		# if the min weight works, use it
-		min_weight = min(weights)
-		if is_divisor(min_weight):
-			return min_weight
-		# if all weights are integers and min_weight is reasonably small, just brute force it
-		if all(int(x) == x for x in weights) and min_weight < BRUTE_LIMIT:
-			for n in xrange(min_weight - 1, 0, -1):
-				if is_divisor(n):
-					return n
-				assert False, "1 was not divisor of all-integer weights"
-		# eh, that'll do.
-		raise ValueError("Could not determine a common divisor of {} unique weights".format(len(weights)))
-
-	def to_repeated_list(self, scale=None):
-		"""Return the playlist in a "repeated list" form - a list of filepaths, using repetition to
-		represent the weights, such that random.choice(self.to_repeated_list()) should give correctly
+		weights = set(weight for weight, vol in self.entries.itervalues()) - {0}
+		if not weights:
+			raise ValueError("Cannot determine a common divisor of no weights")
+		weights = [_to_fraction(weight, tolerance) for weight in weights]
+		numerator = reduce(gcd, (weight.numerator for weight in weights))
+		denominator = reduce(lambda a, b: a * b // gcd(a, b), (weight.denominator for weight in weights))
+		return Fraction(abs(numerator), denominator)
+
+	def repeat_counts(self, scale=None, tolerance=None):
+		"""Yields (path, count) for each entry, where count is the number of times that path
+		should appear in a "repeated list". See iter_repeated() for details."""
+		if scale:
+			for path, (weight, vol) in self.entries.iteritems():
+				yield path, int(weight / scale)
+			return
+		scale = self._common_divisor_weight(tolerance)
+		max_count = max(abs(weight) for weight, vol in self.entries.itervalues()) / scale
+		if max_count > self.REPEAT_LIMIT:
+			raise ValueError("Smallest exact repeated list would need {:.0f} copies of one entry. "
+			                 "Try giving a tolerance or scale.".format(max_count))
+		for path, (weight, vol) in self.entries.iteritems():
+			yield path, int(round(_to_fraction(weight, tolerance) / scale))
+
+	def iter_repeated(self, scale=None, tolerance=None):
+		"""Yields the playlist in a "repeated list" form - filepaths, using repetition to
+		represent the weights, such that random.choice(list(self.iter_repeated())) should give correctly
 		weighted results. Discards volume info.
 		For example, a list like:
 			1 foo
 			2 bar
 			5 baz
-		will return ["foo", "bar", "bar", "baz", "baz", "baz", "baz", "baz"].
-		By default, will attempt to scale the weights to make the result list as small as possible.
-		For example, if the weights were foo=2, bar=4, then the result should be ["foo", "bar", "bar"],
-		not ["foo", "foo", "bar", "bar", "bar", "bar"].
-		This may not always be successful if weights < 1 are present, and will result in ValueError.
+		will give "foo", "bar", "bar", "baz", "baz", "baz", "baz", "baz".
+		By default, will scale the weights by their greatest common divisor to make the result as small
+		as possible. For example, if the weights were foo=2, bar=4, then the result should be "foo", "bar", "bar",
+		not "foo", "foo", "bar", "bar", "bar", "bar".
+		Weights are treated as exact binary fractions, which may give huge results for weights like 0.1.
+		Pass a tolerance (eg. 1e-6) to allow each weight to be approximated by a simpler fraction within that
+		relative tolerance. If the result would need more than REPEAT_LIMIT copies of any path, raises ValueError.
 		If scale is given, it explicitly chooses a value to divide by when translating from weights
 		to number of instances in the result list. eg. In the above example, you could get the same result
 		by passing scale=2. If explicitly given, scale will truncate weights. eg. if you gave scale=2 to the
-		first example with foo, bar and baz, the result would be ["bar", "baz", "baz"] (foo was rounded to 0)
+		first example with foo, bar and baz, the result would be "bar", "baz", "baz" (foo was rounded to 0)
+		Note that any error (eg. ValueError) is raised before anything is yielded.
 		"""
-		if not scale:
-			scale = self._common_divisor_weight()
-		result = []
-		for path, (weight, vol) in self.entries.items():
-			result += [path] * int(weight / scale)
-		return result
+		counts = self.repeat_counts(scale, tolerance)
+		for path, count in counts:
+			for _ in xrange(count):
+				yield path
+
+	def to_repeated_list(self, scale=None, tolerance=None):
+		"""As per iter_repeated(), but returns a list."""
+		return list(self.iter_repeated(scale, tolerance))
 
 	__repr__ = __str__
 
 
+def _to_fraction(value, tolerance=None):
+	"""Convert a float to a Fraction, either exactly or, if tolerance is given, by the closest fraction
+	with a small enough denominator to guarentee being within that relative tolerance."""
+	value = Fraction(value)
+	if tolerance and value:
+		# the closest fraction with denominator <= n is always within 1/2n
+		value = value.limit_denominator(max(1, int(math.ceil(1 / (2 * tolerance * abs(value))))))
+	return value
+
+
+def merge_all(playlists, strategy=None):
+	"""Merge any number of playlists in a single pass, yielding (path, weight, volume) for each
+	entry of the result in order of first appearance.
+	playlists may be filenames or Playlists. Filenames are read one at a time, so only one is held
+	in memory at once.
+	strategy is as per Playlist.merge, except that strategy functions are called with one value
+	per playlist, ie. (path, first_value, second_value, ...), with None for playlists that lack
+	that entry. All strategies in MergeStrategies accept any number of values.
+	The default strategy is as per Playlist.merge, using the first playlist as "this" playlist.
+	"""
+	values = OrderedDict() # {path: [(weight, volume) or None for each playlist]}
+	for i, playlist in enumerate(playlists):
+		if not isinstance(playlist, Playlist):
+			playlist = Playlist(playlist)
+		if strategy is None:
+			vol_average = sum(vol for weight, vol in playlist.entries.itervalues()) / len(playlist.entries)
+			strategy = MergeStrategies.average, MergeStrategies.extreme(vol_average)
+		for path, value in playlist.entries.iteritems():
+			if path not in values:
+				values[path] = [None] * len(playlists)
+			values[path][i] = value
+		playlist = None # don't hold onto it while loading the next one
+
+	if callable(strategy):
+		# use the same for both
+		strategies = strategy, strategy
+	else:
+		strategies = strategy
+
+	for path, entries in values.iteritems():
+		weights, volumes = zip(*(entry or (None, None) for entry in entries))
+		weight, volume = (strategy(path, *vals) for strategy, vals in zip(strategies, (weights, volumes)))
+		if weight is not None and volume is not None:
+			yield path, weight, volume
+
 
 class MergeStrategies(object):
 	def __new__(*args): raise NotImplementedError("This class should not be instantiated")
@@ -253,19 +784,21 @@ class MergeStrategies(object):
 		return _extreme
 
 	@staticmethod
-	def update(path, old, new):
-		"""Always use the new value, unless it doesn't exist (in which case use the old value)"""
-		if new is None: return old
-		return new
+	def update(path, old, *new):
+		"""Always use the new value, unless it doesn't exist (in which case use the old value).
+		Given several new values, uses the last one that exists."""
+		new = [x for x in new if x is not None]
+		if not new: return old
+		return new[-1]
 
 	@staticmethod
 	def existsonly(strategy):
 		"""Factory function. Wraps another strategy, making it return None unless the path is already present
 		in the current playlist. If given a tuple, will wrap both strategies."""
 		def _existsonly_factory(single_strat):
-			def _existsonly(path, old, new):
+			def _existsonly(path, old, *new):
 				if old is None: return None
-				return strategy(path, old, new)
+				return single_strat(path, old, *new)
 			return _existsonly
 		if callable(strategy):
 			return _existsonly_factory(strategy)
@@ -273,10 +806,9 @@ class MergeStrategies(object):
 			return [_existsonly_factory(strat_func) for strat_func in strategy]
 
 
-AUDIO_EXTENSIONS = ['flac', 'aac', 'm4a', 'wav', 'ogg', 'mp3', 'wma']
 def from_directory(root, weight=16, volume=0.5, extensions=AUDIO_EXTENSIONS, use_magic=True,
                    recurse=True, relative=False, detect_duplicates=True, followlinks=False,
-                   onerror=None):
+                   onerror=None, workers=8, cache=None, index=None):
 	"""Constructs a playlist by scanning a directory and all sub-directories.
 	All found files will be added to the playlist with the given weight and volume.
 	Other options:
@@ -291,53 +823,52 @@ def from_directory(root, weight=16, volume=0.5, extensions=AUDIO_EXTENSIONS, use
 		                   Otherwise the first one found is used.
 		followlinks: As per os.walk
 		onerror: As per os.walk
+		workers: Number of threads to use for checking files with libmagic.
+		cache: A filepath (or scan.ScanCache) to cache libmagic results in, so that
+		       unchanged files are not checked again on later scans.
+		index: A filepath (or scan.DirectoryIndex) to keep a record of directory contents in,
+		       so that on later scans unchanged directories do not need to be listed again.
+		       The index is updated and saved.
 	"""
 
-	magic = None
-	if use_magic:
-		try:
-			import magic
-			magic = magic.Magic(mime=True)
-		except ImportError:
-			use_magic = False
-
 	if not relative:
 		root = os.path.abspath(root)
 
 	playlist = Playlist()
-	duplicate_check = {}
-
-	for path, subdirs, files in os.walk(root, followlinks=followlinks, onerror=onerror):
-		if not recurse:
-			# empty list in-place
-			while subdirs: subdirs.pop()
-
-		for file in files:
-			filepath = os.path.join(path, file)
-			name, ext = os.path.splitext(filepath)
-			ext = ext.lower().lstrip('.')
-
-			if (not extensions or ext not in extensions):
-				if not use_magic:
-					continue
-				mime = magic.from_file(filepath)
-				if not mime or not mime.startswith('audio/'):
-					continue
-
-			if detect_duplicates:
-				if name in duplicate_check:
-					other = duplicate_check[name]
-					if extensions and ext in extensions:
-						junk, other_ext = os.path.splitext(other)
-						other_ext = other_ext.lower().lstrip('.')
-						if other_ext in extensions and extensions.index(other_ext) <= extensions.index(ext):
-							continue
-						playlist.entries.pop(other)
-					else:
-						continue
-
-				duplicate_check[name] = filepath
-
-			playlist.add_item(filepath, weight=weight, volume=volume)
+
+	kwargs = dict(extensions=extensions, use_magic=use_magic, recurse=recurse,
+	              followlinks=followlinks, onerror=onerror, workers=workers, cache=cache)
+	if index is None:
+		found = find_audio(root, **kwargs)
+	else:
+		if not isinstance(index, DirectoryIndex):
+			index = DirectoryIndex(index)
+		index.scan(root, **kwargs)
+		index.save()
+		found = index.files()
+
+	if detect_duplicates:
+		found = remove_duplicates(found, extensions)
+	for filepath in found:
+		playlist.add_item(filepath, weight=weight, volume=volume)
 
 	return playlist
+
+
+def remove_duplicates(filepaths, extensions=AUDIO_EXTENSIONS):
+	"""Returns a list of filepaths with duplicates removed, as per from_directory's detect_duplicates.
+	A file that replaces an earlier duplicate takes its place at the end of the list so far."""
+	kept = OrderedDict() # {path without extension: filepath}
+	for filepath in filepaths:
+		name, ext = os.path.splitext(filepath)
+		ext = ext.lower().lstrip('.')
+		if name in kept:
+			if not (extensions and ext in extensions):
+				continue
+			junk, other_ext = os.path.splitext(kept[name])
+			other_ext = other_ext.lower().lstrip('.')
+			if other_ext in extensions and extensions.index(other_ext) <= extensions.index(ext):
+				continue
+			del kept[name]
+		kept[name] = filepath
+	return kept.values()
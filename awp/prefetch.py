@@ -0,0 +1,77 @@
+"""Reading the start of upcoming tracks ahead of time, so they start promptly from slow disks or NFS."""
+
+import logging
+import os
+
+import gevent
+
+try:
+	from os import posix_fadvise, POSIX_FADV_WILLNEED
+except ImportError:
+	try:
+		import ctypes
+		import ctypes.util
+		_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		_libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+	except (ImportError, OSError, AttributeError):
+		posix_fadvise = None
+	else:
+		POSIX_FADV_WILLNEED = 3 # as on linux
+		def posix_fadvise(fd, offset, length, advice):
+			err = _libc.posix_fadvise(fd, offset, length, advice)
+			if err:
+				raise OSError(err, os.strerror(err))
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Prefetcher(object):
+	"""Warms the first budget bytes of a file into the page cache in a background thread.
+	Call prefetch() with the next track as soon as it's chosen, and started() when it actually starts.
+	A track counts as a hit if its prefetch had successfully finished by the time it started, and a miss otherwise.
+	Hits and misses are logged, and counted in stats (an instrument.Stats) if given.
+	If budget is 0, nothing is prefetched.
+	"""
+
+	def __init__(self, budget=8 * 1024 * 1024, stats=None):
+		self.budget = budget
+		self.stats = stats
+		self.filename = None
+		self.result = None
+		self.hits = 0
+		self.misses = 0
+
+	def prefetch(self, filename):
+		if not self.budget:
+			return
+		self.filename = filename
+		self.result = gevent.get_hub().threadpool.spawn(self._warm, filename, self.budget)
+
+	@staticmethod
+	def _warm(filename, budget):
+		"""Runs in a thread. Ask the kernel to read ahead if we can, and also read the file
+		ourselves, as some filesystems (eg. NFS) don't act on the advice. Returns whether it succeeded."""
+		try:
+			with open(filename, 'rb') as f:
+				if posix_fadvise:
+					posix_fadvise(f.fileno(), 0, budget, POSIX_FADV_WILLNEED)
+				remaining = budget
+				while remaining > 0 and f.read(min(CHUNK_SIZE, remaining)):
+					remaining -= CHUNK_SIZE
+		except (OSError, IOError):
+			logging.debug("Failed to prefetch {!r}".format(filename), exc_info=True)
+			return False
+		return True
+
+	def started(self, filename):
+		if not self.budget:
+			return
+		hit = filename == self.filename and self.result.ready() and self.result.get()
+		if hit:
+			self.hits += 1
+		else:
+			self.misses += 1
+		if self.stats:
+			self.stats.count('prefetch_hits' if hit else 'prefetch_misses')
+		logging.info("Prefetch {} for {!r} ({} hits, {} misses)".format(
+			'hit' if hit else 'miss', filename, self.hits, self.misses))
@@ -1,11 +1,93 @@
 import random
+from array import array
 
-def weighted_choice(d):
-	"""Choose a random key from d, with each choice weighted by the value of d, which may be int or float."""
+class WeightedIndex(object):
+	"""A persistent index for repeatedly choosing from a sequence of weights.
+	It is implemented as a Fenwick (binary indexed) tree, so building it is O(n), and choosing,
+	changing a weight or appending a new weight are all O(log n).
+	Choices return the position of the chosen weight in the sequence.
+	If weights is a list or array, it is used directly rather than copied, and should only
+	be modified through this object from then on.
+	"""
 
-	total = sum(d.values())
-	x = random.random() * total
-	for k in d:
-		x -= d[k]
-		if x <= 0:
-			return k
+	def __init__(self, weights=()):
+		self.weights = weights if isinstance(weights, (list, array)) else list(weights)
+		self._build()
+
+	def _build(self):
+		"""Build the tree from scratch from self.weights. This also discards any accumulated float error."""
+		n = len(self.weights)
+		tree = array('d', [0])
+		tree.extend(self.weights)
+		for i in xrange(1, n + 1):
+			parent = i + (i & -i)
+			if parent <= n:
+				tree[parent] += tree[i]
+		self.tree = tree
+		self.total = sum(self.weights)
+		self.positive = sum(1 for weight in self.weights if weight > 0) # number of weights that can be chosen
+		self._changes = 0
+
+	def __len__(self):
+		return len(self.weights)
+
+	def __getitem__(self, i):
+		return self.weights[i]
+
+	def __setitem__(self, i, weight):
+		delta = weight - self.weights[i]
+		self.positive += (weight > 0) - (self.weights[i] > 0)
+		self.weights[i] = weight
+		# with nothing left to choose, total can only be float error
+		self.total = self.total + delta if self.positive else 0
+		i += 1
+		while i < len(self.tree):
+			self.tree[i] += delta
+			i += i & -i
+		# every update can add float error to the sums, so periodically start again
+		self._changes += 1
+		if self._changes > len(self.weights):
+			self._build()
+
+	def append(self, weight):
+		"""Add a new weight to the end of the sequence. Returns its position."""
+		i = len(self.tree)
+		# the new node covers the range (i - lowbit(i), i], ie. the new weight plus
+		# the children that are completed by it.
+		value = weight
+		child = i - 1
+		stop = i - (i & -i)
+		while child > stop:
+			value += self.tree[child]
+			child -= child & -child
+		self.tree.append(value)
+		self.weights.append(weight)
+		self.total += weight
+		self.positive += weight > 0
+		return i - 1
+
+	def find(self, x):
+		"""Return the position of the weight which covers point x, where 0 <= x < total.
+		Returns len(self) if x is past the end."""
+		pos = 0
+		step = 1
+		while step * 2 < len(self.tree):
+			step *= 2
+		while step:
+			if pos + step < len(self.tree) and self.tree[pos + step] <= x:
+				pos += step
+				x -= self.tree[pos]
+			step //= 2
+		return pos
+
+	def choice(self, random=random.random):
+		"""Choose a random position, weighted by the weight at that position."""
+		while True:
+			if not (self.positive and self.total > 0):
+				raise IndexError("Cannot choose from an index with no positive weights")
+			i = self.find(random() * self.total)
+			if i < len(self.weights) and self.weights[i] > 0:
+				return i
+			# float error in the sums put us past the last entry or onto a zero weight.
+			# Rebuild from the exact weights before trying again.
+			self._build()
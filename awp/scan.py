@@ -0,0 +1,367 @@
+
+"""Tools for quickly scanning directory trees for audio files"""
+
+import cPickle as pickle
+import errno
+import os
+from collections import OrderedDict
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+
+AUDIO_EXTENSIONS = ['flac', 'aac', 'm4a', 'wav', 'ogg', 'mp3', 'wma']
+
+
+def walk(top, recurse=True, followlinks=False, onerror=None):
+	"""As per os.walk (top-down), but uses scandir (if available) to avoid needing to stat()
+	every entry to tell files from directories. As with os.walk, the caller may modify the
+	yielded list of subdirectories in-place to control which are visited.
+	If recurse is False, only top is listed."""
+	if scandir is None:
+		for path, subdirs, files in os.walk(top, followlinks=followlinks, onerror=onerror):
+			if not recurse:
+				# empty list in-place
+				while subdirs: subdirs.pop()
+			yield path, subdirs, files
+		return
+
+	try:
+		subdirs, files, links = list_dir(top)
+	except OSError as e:
+		if onerror is not None:
+			onerror(e)
+		return
+
+	yield top, subdirs, files
+
+	if not recurse:
+		return
+	for name in subdirs:
+		if followlinks or name not in links:
+			for result in walk(os.path.join(top, name), recurse, followlinks, onerror):
+				yield result
+
+
+def list_dir(path):
+	"""Returns (subdirs, files, links) for a directory, where subdirs and files are lists of names
+	(with symlinks categorized by what they point to, as per os.walk) and links is the set of names
+	which are symlinks. Uses scandir if available."""
+	subdirs = []
+	files = []
+	links = set()
+	if scandir is None:
+		for name in os.listdir(path):
+			if os.path.isdir(os.path.join(path, name)):
+				subdirs.append(name)
+			else:
+				files.append(name)
+			if os.path.islink(os.path.join(path, name)):
+				links.add(name)
+		return subdirs, files, links
+	for entry in scandir(path):
+		try:
+			is_dir = entry.is_dir() # follows symlinks, as per os.walk
+		except OSError:
+			is_dir = False
+		if is_dir:
+			subdirs.append(entry.name)
+		else:
+			files.append(entry.name)
+		if entry.is_symlink():
+			links.add(entry.name)
+	return subdirs, files, links
+
+
+class ScanCache(object):
+	"""A persistent cache of some value for each file, which is discarded when the file's
+	inode, size or mtime changes. It is stored in the given file as a pickle
+	(which unlike JSON preserves byte string paths). It is safe to use from multiple threads."""
+
+	MISSING = object() # returned from get() on a cache miss, as None may be a valid value
+
+	def __init__(self, filepath):
+		self.filepath = filepath
+		try:
+			with open(filepath, 'rb') as f:
+				self.entries = pickle.load(f)
+		except IOError as e:
+			if e.errno != errno.ENOENT: raise
+			self.entries = {}
+
+	@staticmethod
+	def _key(stat):
+		return stat.st_ino, stat.st_size, stat.st_mtime
+
+	def get(self, path, stat):
+		key, value = self.entries.get(path, (None, None))
+		if key != self._key(stat):
+			return self.MISSING
+		return value
+
+	def set(self, path, stat, value):
+		self.entries[path] = self._key(stat), value
+
+	def save(self):
+		_save_pickle(self.filepath, self.entries)
+
+
+def _save_pickle(filepath, value):
+	"""Atomically replace filepath with a pickle of value"""
+	dirname, basename = os.path.split(filepath)
+	tmp_path = os.path.join(dirname, ".{}~".format(basename))
+	with open(tmp_path, 'wb') as f:
+		pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+	os.rename(tmp_path, filepath)
+
+
+class MimeProber(object):
+	"""Identifies file types with libmagic, optionally using a ScanCache.
+	libmagic handles aren't thread-safe, so each thread gets its own."""
+
+	def __init__(self, cache=None):
+		import magic
+		self.magic = magic
+		self.cache = cache
+		self.local = threading.local()
+
+	def __call__(self, filepath):
+		stat = None
+		if self.cache is not None:
+			stat = os.stat(filepath)
+			mime = self.cache.get(filepath, stat)
+			if mime is not ScanCache.MISSING:
+				return mime
+		if not hasattr(self.local, 'magic'):
+			self.local.magic = self.magic.Magic(mime=True)
+		mime = self.local.magic.from_file(filepath)
+		if self.cache is not None:
+			self.cache.set(filepath, stat, mime)
+		return mime
+
+
+def _get_prober(use_magic, cache):
+	"""Returns a MimeProber, or None if use_magic is False or libmagic isn't available"""
+	if not use_magic:
+		return None
+	try:
+		return MimeProber(cache)
+	except ImportError:
+		return None
+
+
+def filter_audio(filepaths, extensions=AUDIO_EXTENSIONS, prober=None, workers=8):
+	"""Yields those of filepaths which are audio files, in order.
+	Files with an extension in extensions are assumed to be audio files.
+	Otherwise, if prober (a MimeProber) is given it is used to check them. These checks are done
+	by a pool of worker threads, so they can overlap with each other and with consuming filepaths.
+	"""
+	def candidates():
+		for filepath in filepaths:
+			name, ext = os.path.splitext(filepath)
+			ext = ext.lower().lstrip('.')
+			if extensions and ext in extensions:
+				yield filepath, False
+			elif prober:
+				yield filepath, True
+
+	def check(candidate):
+		filepath, needs_probe = candidate
+		if needs_probe:
+			mime = prober(filepath)
+			if not mime or not mime.startswith('audio/'):
+				return None
+		return filepath
+
+	if prober is None:
+		for filepath, needs_probe in candidates():
+			yield filepath
+		return
+
+	pool = ThreadPool(workers)
+	try:
+		# imap consumes candidates in a background thread while the workers check files
+		for filepath in pool.imap(check, candidates(), chunksize=16):
+			if filepath is not None:
+				yield filepath
+	finally:
+		pool.terminate()
+
+
+def find_audio(root, extensions=AUDIO_EXTENSIONS, use_magic=True, recurse=True,
+               followlinks=False, onerror=None, workers=8, cache=None):
+	"""Yields the paths of all audio files under root, in the same order as os.walk would find them.
+	Files with an extension in extensions are assumed to be audio files.
+	Otherwise, if use_magic is True and the python-magic library is available, libmagic is used
+	to check if they are audio files, using workers threads (see filter_audio).
+	If cache is given (a ScanCache or a filepath), results of these checks are cached there
+	and not repeated for unchanged files.
+	"""
+	if cache is not None and not isinstance(cache, ScanCache):
+		cache = ScanCache(cache)
+	prober = _get_prober(use_magic, cache)
+
+	filepaths = (os.path.join(path, file)
+	             for path, subdirs, files in walk(root, recurse=recurse, followlinks=followlinks, onerror=onerror)
+	             for file in files)
+	try:
+		for filepath in filter_audio(filepaths, extensions, prober, workers):
+			yield filepath
+	finally:
+		if cache is not None:
+			cache.save()
+
+
+def verify_paths(paths, workers=8, cache=None):
+	"""Yields those of paths which do not exist (or are unreadable symlinks), as they are found.
+	Paths are grouped by directory, and each directory is listed once rather than checking each path
+	individually, which is much faster on network filesystems. Note this means that (other than for
+	symlinks) a file's read permission is not checked. If a directory cannot be listed, each path
+	in it is checked with os.access instead.
+	Directories are checked concurrently by a pool of workers threads.
+	If cache is given (a ScanCache or a filepath), directory listings are cached there and
+	re-used on later runs for directories which haven't changed.
+	"""
+	if cache is not None and not isinstance(cache, ScanCache):
+		cache = ScanCache(cache)
+
+	by_dir = OrderedDict()
+	for path in paths:
+		dirpath, name = os.path.split(path)
+		by_dir.setdefault(dirpath, []).append(name)
+
+	def check_dir(item):
+		dirpath, names = item
+		try:
+			listing = ScanCache.MISSING
+			if cache is not None:
+				stat = os.stat(dirpath or '.')
+				listing = cache.get(dirpath, stat)
+			if listing is ScanCache.MISSING:
+				subdirs, files, links = list_dir(dirpath or '.')
+				listing = frozenset(files), frozenset(links)
+				if cache is not None:
+					cache.set(dirpath, stat, listing)
+		except OSError:
+			# can't list it (eg. it's missing, or we lack permission), so check each file
+			return [path for path in (os.path.join(dirpath, name) for name in names)
+			        if not os.access(path, os.R_OK)]
+		files, links = listing
+		return [os.path.join(dirpath, name) for name in names
+		        if name not in files or (name in links and not os.access(os.path.join(dirpath, name), os.R_OK))]
+
+	pool = ThreadPool(workers)
+	try:
+		for bad in pool.imap_unordered(check_dir, by_dir.iteritems()):
+			for path in bad:
+				yield path
+	finally:
+		pool.terminate()
+		if cache is not None:
+			cache.save()
+
+
+class DirectoryIndex(object):
+	"""A persistent record of the audio files in each directory of a tree, along with the mtime
+	of each directory. It is stored in the given file as a pickle.
+
+	A directory's mtime changes whenever an entry is added to, removed from or renamed within it.
+	So to bring the index up to date, scan() only needs to stat() each directory, and only lists
+	and checks the files of those whose mtime has changed.
+	Note this means changes to the contents of existing files (eg. to their libmagic type) are not noticed.
+
+	Tools may also store results derived from the index in reports, keyed by name. Such results should
+	record the mtime of each directory they were derived from, so they can be brought up to date by
+	recomputing only the directories whose mtime has since changed (see missing.py). All reports are
+	discarded if the index is rebuilt with different options.
+	"""
+
+	def __init__(self, filepath):
+		self.filepath = filepath
+		try:
+			with open(filepath, 'rb') as f:
+				data = pickle.load(f)
+		except IOError as e:
+			if e.errno != errno.ENOENT: raise
+			data = {'options': None, 'dirs': {}}
+		self.options = data['options']
+		self.dirs = data['dirs'] # {path: (mtime, subdirs, audio files)}
+		self.reports = data.get('reports', {})
+
+	def scan(self, root, extensions=AUDIO_EXTENSIONS, use_magic=True, recurse=True,
+	         followlinks=False, onerror=None, workers=8, cache=None):
+		"""Bring the index up to date with the tree at root. Arguments are as per find_audio."""
+		options = root, tuple(extensions or ()), use_magic, recurse, followlinks
+		old_dirs = self.dirs if options == self.options else {}
+		if options != self.options:
+			self.reports = {}
+		if cache is not None and not isinstance(cache, ScanCache):
+			cache = ScanCache(cache)
+		prober = _get_prober(use_magic, cache)
+
+		dirs = {}
+		changed = [] # directories which need their files checked, as (path, entry, names)
+
+		def visit(path):
+			try:
+				mtime = os.stat(path).st_mtime
+				entry = old_dirs.get(path)
+				if entry is None or entry[0] != mtime:
+					subdirs, files, links = list_dir(path)
+					entry = mtime, [name for name in subdirs if followlinks or name not in links], []
+					changed.append((path, entry, files))
+			except OSError as e:
+				if onerror is not None:
+					onerror(e)
+				return
+			dirs[path] = entry
+			if recurse:
+				for name in entry[1]:
+					visit(os.path.join(path, name))
+
+		visit(root)
+
+		filepaths = (os.path.join(path, name) for path, entry, names in changed for name in names)
+		entries = {path: entry for path, entry, names in changed}
+		try:
+			for filepath in filter_audio(filepaths, extensions, prober, workers):
+				path, name = os.path.split(filepath)
+				entries[path][2].append(name)
+		finally:
+			if cache is not None:
+				cache.save()
+
+		self.options = options
+		self.dirs = dirs
+
+	def walk(self):
+		"""Yields (path, mtime, audio files) for each directory in the index, in the same order as os.walk."""
+		if not self.options:
+			return
+		root, recurse = self.options[0], self.options[3]
+		stack = [root]
+		while stack:
+			path = stack.pop()
+			entry = self.dirs.get(path)
+			if entry is None:
+				continue
+			mtime, subdirs, files = entry
+			yield path, mtime, files
+			if recurse:
+				stack.extend(os.path.join(path, name) for name in reversed(subdirs))
+
+	def files(self):
+		"""Yields all audio files in the index, in the same order as os.walk would find them."""
+		for path, mtime, files in self.walk():
+			for name in files:
+				yield os.path.join(path, name)
+
+	def save(self):
+		_save_pickle(self.filepath, {'options': self.options, 'dirs': self.dirs, 'reports': self.reports})
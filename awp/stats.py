@@ -1,22 +1,170 @@
 
-"""Print stats about a playlist file"""
+"""Print stats about playlist files.
+Each file is read in a single streaming pass without loading it as a Playlist,
+and multiple files are processed in parallel."""
 
-import errno
+import math
+import mmap
+import os
+import sys
+from array import array
 from collections import Counter
+from multiprocessing import Pool
 
-from scriptlib import with_argv
-from playlist import Playlist
+import argh
 
-@with_argv
-def main(playlist):
-	playlist = Playlist(playlist)
-	print "Total songs: {}".format(len(playlist.entries))
+from playlist import Playlist, BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION
+
+PERCENTILES = (1, 10, 25, 50, 75, 90, 99)
+CHUNK_SIZE = 65536 # entries per read from binary files
+
+
+class PlaylistStats(object):
+	"""Accumulates stats about entries given one at a time to add().
+	Memory use depends only on the number of distinct weights and directories, not the number of entries.
+	depth, if given, groups directories by their first depth path components instead of the
+	full directory name.
+	"""
+
+	def __init__(self, depth=None):
+		self.depth = depth
+		self.count = 0
+		self.total = 0
+		self.by_weight = Counter() # {weight: number of entries}
+		self.by_directory = Counter() # {directory: total weight}
+		self.weight_log_weight = 0 # sum of w*ln(w) over positive weights, for entropy()
+
+	def add(self, path, weight):
+		self.count += 1
+		self.total += weight
+		self.by_weight[weight] += 1
+		self.by_directory[self.directory(path)] += weight
+		if weight > 0:
+			self.weight_log_weight += weight * math.log(weight)
+
+	def directory(self, path):
+		directory = os.path.dirname(path)
+		if self.depth is not None:
+			directory = os.sep.join(directory.split(os.sep)[:self.depth + 1])
+		return directory
+
+	def percentile(self, p):
+		"""The weight below which p percent of entries fall"""
+		target = self.count * p / 100.
+		seen = 0
+		for weight, count in sorted(self.by_weight.items()):
+			seen += count
+			if seen >= target:
+				return weight
+
+	def entropy(self):
+		"""Entropy in bits of the choice of track. With p = w / T,
+		H = -sum(p ln p) = ln T - sum(w ln w) / T"""
+		if self.total <= 0:
+			return 0
+		return (math.log(self.total) - self.weight_log_weight / self.total) / math.log(2)
+
+	def effective_tracks(self):
+		"""Number of equally weighted tracks that would give the same entropy"""
+		return 2 ** self.entropy()
+
+
+def iter_entries(filepath):
+	"""Yields (path, weight) for each entry of a playlist file, streaming it rather than loading it all.
+	Duplicate entries are not detected. If the playlist has a journal, it must be applied
+	on top of the file, so the playlist is loaded normally."""
+	if os.path.exists(Playlist.journal_path(filepath)):
+		for path, (weight, volume) in Playlist(filepath).entries.iteritems():
+			yield path, weight
+		return
+	with open(filepath, 'rb') as f:
+		if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+			for entry in _iter_binary(f):
+				yield entry
+			return
+		f.seek(0)
+		for lineno, line in enumerate(f, 1):
+			line = line.rstrip('\n')
+			if not line or line.lstrip().startswith('#'):
+				continue
+			parts = line.split('\t', 2)
+			if len(parts) < 2:
+				raise ValueError("{}: bad line {}: {}".format(filepath, lineno, line))
+			try:
+				weight = float(parts[0])
+			except ValueError as e:
+				raise ValueError("{}: bad line {}: {}: {}".format(filepath, lineno, e, line))
+			yield parts[-1], weight
+
+
+def _iter_binary(f):
+	data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		magic, version, count = BINARY_HEADER.unpack_from(data)
+		if version != BINARY_VERSION:
+			raise ValueError("Unknown binary playlist version: {}".format(version))
+		weights_offset = BINARY_HEADER.size
+		path_offset = weights_offset + 2 * count * 8 # skip weight and volume columns
+		for start in xrange(0, count, CHUNK_SIZE):
+			weights = array('d')
+			weights.fromstring(data[weights_offset + start * 8:weights_offset + min(count, start + CHUNK_SIZE) * 8])
+			if sys.byteorder != 'little':
+				weights.byteswap()
+			for weight in weights:
+				end = data.find('\n', path_offset)
+				if end < 0:
+					raise ValueError("Corrupt binary playlist: expected {} paths".format(count))
+				yield data[path_offset:end], weight
+				path_offset = end + 1
+	finally:
+		data.close()
+
+
+def analyze(filepath, depth=None):
+	stats = PlaylistStats(depth)
+	for path, weight in iter_entries(filepath):
+		stats.add(path, weight)
+	return stats
+
+
+def _analyze(args):
+	return analyze(*args)
+
+
+def report(filepath, stats, top):
+	print "{}:".format(filepath)
+	print "Total songs: {}".format(stats.count)
+	if not stats.count:
+		return
 	print "Count by weight:"
-	by_weight = Counter(weight for weight, volume in playlist.entries.values())
-	total = sum(weight for weight, volume in playlist.entries.values())
-	for weight, count in sorted(by_weight.items()):
-		print "{}x : {} songs\t({:5.2f}% total chance)".format(weight, count, 100 * weight * count / total)
+	for weight, count in sorted(stats.by_weight.items()):
+		print "{}x : {} songs\t({:5.2f}% total chance)".format(weight, count, 100 * weight * count / stats.total)
+	print "Weight percentiles: {}".format(', '.join(
+		'{}%: {}'.format(p, stats.percentile(p)) for p in PERCENTILES))
+	print "Entropy: {:.2f} bits (effectively {:.0f} equally likely songs)".format(
+		stats.entropy(), stats.effective_tracks())
+	print "Top directories by total chance:"
+	for directory, weight in stats.by_directory.most_common(top):
+		print "{:6.2f}% {}".format(100 * weight / stats.total, directory)
+
+
+@argh.arg('playlists', nargs='+')
+@argh.arg('--depth', type=int, help='group directories by their first DEPTH path components')
+@argh.arg('--top', type=int, help='number of directories to show')
+@argh.arg('--processes', type=int, help='number of files to process at once. Defaults to number of CPUs.')
+def main(playlists, depth=None, top=10, processes=None):
+	if len(playlists) == 1:
+		results = [analyze(playlists[0], depth)]
+	else:
+		pool = Pool(processes)
+		try:
+			results = pool.map(_analyze, [(filepath, depth) for filepath in playlists])
+		finally:
+			pool.terminate()
+	for filepath, stats in zip(playlists, results):
+		report(filepath, stats, top)
+		print
 
 
 if __name__=='__main__':
-	main()
+	argh.dispatch_command(main)
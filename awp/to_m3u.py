@@ -2,24 +2,32 @@
 """Tool to write out a playlist in m3u format using repetition for weight"""
 
 import os
+import sys
 
 from argh import dispatch_command, arg
 
 from playlist import Playlist
 
+CHUNK_SIZE = 1024 # max copies of a line to write at once
 
-@arg('--scale', type=int, help='scale to pass through to Playlist.to_repeated_list')
-def main(playlist, src, dest, scale=None, url=False):
+
+@arg('--scale', type=int, help='scale to pass through to Playlist.iter_repeated')
+@arg('--tolerance', type=float, help='tolerance to pass through to Playlist.iter_repeated')
+def main(playlist, src, dest, scale=None, tolerance=None, url=False):
 	"""Writes the playlist in m3u format to stdout, using repetition for weight.
 	src and dest args are for path rewriting - any paths under src will be rewritten
 	to be under dest instead."""
 	playlist = Playlist(playlist)
-	flattened = playlist.to_repeated_list(scale)
 	src = '{}/'.format(src.rstrip('/'))
-	for path in flattened:
+	for path, count in playlist.repeat_counts(scale, tolerance):
+		# rewritten as strings rather than with Playlist.rewrite_prefix(), as paths which end up
+		# the same as another are fine here, and we never save the playlist
 		if path.startswith(src):
 			path = os.path.join(dest, os.path.relpath(path, src))
-		print 'file://{}'.format(path) if url else path
+		line = 'file://{}\n'.format(path) if url else '{}\n'.format(path)
+		while count > 0:
+			sys.stdout.write(line * min(count, CHUNK_SIZE))
+			count -= CHUNK_SIZE
 
 
 if __name__=='__main__':
@@ -0,0 +1,77 @@
+"""Change the weight and/or volume of many entries of a playlist at once.
+
+Changes are given as python expressions of x, the old value. The expressions may also use
+count and total, the number and total weight of the selected entries, and the math module.
+If numpy is available (and --scalar isn't given), each expression is evaluated only once,
+with x as a numpy array of all the old values, so elementwise functions should come from numpy.
+
+Examples:
+	Decay every weight 10% of the way towards 16:
+		python -m awp.transform PLAYLIST --weight '16 + (x - 16) * 0.9'
+	Rescale weights so the average is 16:
+		python -m awp.transform PLAYLIST --weight 'x * 16 * count / total'
+	Halve the weight of everything under a directory:
+		python -m awp.transform PLAYLIST --under /mnt/music/foo --weight 'x / 2'
+"""
+
+import math
+import re
+
+import argh
+
+from playlist import Playlist
+
+
+def compile_expression(expression, **names):
+	"""Returns a function of x that evaluates the expression"""
+	namespace = dict(math=math, **names)
+	try:
+		import numpy
+	except ImportError:
+		pass
+	else:
+		namespace['numpy'] = numpy
+	return eval('lambda x: ({})'.format(expression), namespace)
+
+
+@argh.arg('--weight', help='expression giving the new weight')
+@argh.arg('--volume', help='expression giving the new volume')
+@argh.arg('--under', help='only change entries under this directory')
+@argh.arg('--match', help='only change entries whose path matches this regex')
+@argh.arg('--paths', help='only change entries listed in this file, one path per line')
+@argh.arg('--scalar', help='evaluate expressions once per entry, even if numpy is available')
+@argh.arg('--journal', help='save changes to the journal instead of rewriting the playlist')
+@argh.arg('--output', help='write the result to this file instead of saving the playlist')
+def main(playlist, weight=None, volume=None, under=None, match=None, paths=None,
+         scalar=False, journal=False, output=None):
+	playlist = Playlist(playlist, journal=journal)
+	if paths is not None:
+		with open(paths) as f:
+			paths = [line.rstrip('\n') for line in f if line.strip()]
+	predicate = re.compile(match).search if match else None
+	selected = playlist.select(paths, under, predicate)
+
+	if scalar:
+		vectorized = False
+	else:
+		try:
+			import numpy
+		except ImportError:
+			vectorized = False
+		else:
+			vectorized = True
+
+	names = dict(count=len(selected), total=sum(playlist.entries[path][0] for path in selected))
+	weight = compile_expression(weight, **names) if weight else None
+	volume = compile_expression(volume, **names) if volume else None
+	count = playlist.transform(weight, volume, paths=selected, vectorized=vectorized)
+
+	if output:
+		playlist.writefile(output)
+	else:
+		playlist.save()
+	print "Changed {} entries".format(count)
+
+
+if __name__ == '__main__':
+	argh.dispatch_command(main)
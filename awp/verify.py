@@ -1,16 +1,25 @@
 
+"""Print all entries in a playlist whose files cannot be accessed, as they are found.
+Exits with status 1 if there were any."""
+
 import sys
 
 import argh
 
 from awp.playlist import Playlist
+from awp.scan import verify_paths
 
 
-def main(playlist):
+@argh.arg('--workers', type=int, help='number of directories to check at once')
+@argh.arg('--cache', help='file to cache directory listings in, so unchanged directories are not listed again')
+def main(playlist, workers=8, cache=None):
 	playlist = Playlist(playlist)
-	bad = playlist.verify()
+	bad = False
+	for path in verify_paths(playlist.entries, workers=workers, cache=cache):
+		print path
+		sys.stdout.flush()
+		bad = True
 	if bad:
-		print '\n'.join(bad)
 		sys.exit(1)
 
 
@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
 	name='awp',
 	description='Auto-weighted playlist player',
-	packages=['awp'],
+	packages=['awp', 'awp.benchmark'],
 	install_requires=[
 		'escapes',
 		'scriptlib',